@@ -28,7 +28,14 @@ __docformat__ = 'restructuredtext'
 
 from spark_parser.ast import AST
 from spark_parser.ast import GenericASTTraversal, GenericASTTraversalPruningException
-from spark_parser.spark import DEFAULT_DEBUG, rule2str, GenericASTBuilder, GenericParser
+from spark_parser.spark import (
+    DEFAULT_DEBUG,
+    rule2str,
+    GenericASTBuilder,
+    GenericParser,
+    ParseResult,
+    PrefixCache,
+)
 from spark_parser.scanner import GenericScanner, GenericToken
 
 __all__ = [
@@ -41,6 +48,8 @@ __all__ = [
     "GenericASTTraversalPruningException",
     "GenericParser",
     "GenericScanner",
-    "GenericToken"
+    "GenericToken",
+    "ParseResult",
+    "PrefixCache",
     "rule2str",
     ]
@@ -15,7 +15,7 @@ from spark_parser.ast import AST
 
 from gdbloc.scanner import LocationScanner, ScannerError
 
-from spark_parser import GenericASTBuilder, DEFAULT_DEBUG
+from spark_parser import GenericASTBuilder, PrefixCache, DEFAULT_DEBUG
 
 class LocationError(Exception):
     def __init__(self, text, text_cursor):
@@ -31,6 +31,10 @@ class LocationParser(GenericASTBuilder):
     Note: function parse() comes from GenericASTBuilder
     """
 
+    # Debugger commands typed one after another often start out alike;
+    # parse() picks up from the Earley sets of earlier ones
+    prefix_cache = PrefixCache()
+
     def __init__(self, start_nt, text, debug=DEFAULT_DEBUG):
         super(LocationParser, self).__init__(AST, start_nt, debug=debug)
         self.debug = debug
@@ -158,6 +162,8 @@ def parse_location(start_symbol, text, out=sys.stdout,
 
     parser = LocationParser(start_symbol, text, parser_debug)
     parser.check_grammar(frozenset(('bp_start', 'range_start', 'arange_start')))
+    # Later LocationParsers reuse the state machine built here
+    parser.compile()
     return parser.parse(tokens)
 
 def parse_bp_location(*args, **kwargs):
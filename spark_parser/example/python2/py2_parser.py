@@ -27,6 +27,10 @@ class PythonParser(GenericASTBuilder):
     Note: function parse() comes from GenericASTBuilder
     """
 
+    # The statements of a module are much alike; once compiled,
+    # parse() replays how the Earley sets of earlier ones were made
+    memoize_sets = True
+
     def __init__(self, start="file_input", debug=DEFAULT_DEBUG):
         super(PythonParser, self).__init__(AST, start, debug=debug)
         self.start = start
@@ -637,6 +641,8 @@ def parse_python2(
     parser = PythonParser(start=start, debug=parser_debug)
     if check:
         parser.check_grammar()
+    # Later PythonParsers reuse the state machine built here
+    parser.compile()
     return parser.parse(tokens)
 
 
@@ -16,6 +16,11 @@ def _namelist(instance):
                 namedict[name] = 1
     return namelist
 
+
+# The compiled token pattern of each scanner class; see GenericScanner.
+_patterns = {}
+
+
 class GenericToken:
     """A sample Token class that can be used in scanning"""
     def __init__(self, kind, attr=None):
@@ -60,9 +65,12 @@ class GenericScanner:
         self.rv.append(t)
     """
     def __init__(self):
-        pattern = self.reflect()
+        # The pattern depends only on the class, so it is built once
+        cls = self.__class__
+        if cls not in _patterns:
+            _patterns[cls] = re.compile(self.reflect(), re.VERBOSE)
         self.pos = 0
-        self.re = re.compile(pattern, re.VERBOSE)
+        self.re = _patterns[cls]
 
         self.index2func = {}
         for name, number in self.re.groupindex.items():
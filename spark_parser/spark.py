@@ -22,10 +22,20 @@ Copyright (c) 1998-2002 John Aycock
   SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import copy
+import hashlib
+import itertools
 import os
 import pickle
 import re
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from spark_parser.scanner import GenericToken
 
 if sys.version[0:3] <= "2.3":
     from sets import Set as set
@@ -48,20 +58,284 @@ def _namelist(instance):
     return namelist
 
 
+# Names of the p_ methods of each parser class, in the order that
+# collectRules() adds their rules.
+_rule_methods = {}
+
+# The docstrings of p_ methods, already split into (lhs, rhs) pairs;
+# see _parse_rules().  Other rules passed to addRule(), which fork()
+# makes up anew for each change, aren't kept.
+_parsed_rules = {}
+
+_comment_line = re.compile(r"^\s*#")
+
+
+def _parse_rules(doc, cache=False):
+    """Return the (lhs, rhs) pairs of the grammar rules in _doc_, as
+    written: with any *, + or ? suffix still on the rhs.  Comments, lines
+    starting with # and blank lines are skipped.  If _cache_ is set, the
+    result is cached by _doc_, so it must not be changed."""
+    rules = _parsed_rules.get(doc)
+    if rules is not None:
+        return rules
+
+    # remove blanks lines and comment lines, e.g. lines starting with "#"
+    words = " ".join(
+        [s for s in doc.splitlines() if s and not _comment_line.match(s)]
+    ).split()
+
+    index = []
+    for i in range(len(words)):
+        if words[i] == "::=":
+            index.append(i - 1)
+    index.append(len(words))
+
+    rules = []
+    for i in range(len(index) - 1):
+        lhs = words[index[i]]
+        rhs = words[index[i] + 2 : index[i + 1]]
+        rules.append((lhs, tuple(rhs)))
+    if cache:
+        _parsed_rules[doc] = rules
+    return rules
+
+
+def _splice(action):
+    """Return a rule action that calls _action_ with the symbols of a
+    tail nonterminal, the last argument, in place of the tail; see
+    GenericParser.splitRule()."""
+    return lambda args: action(args[:-1] + args[-1])
+
+
+def _chain(units, action):
+    """Return a rule action that calls _action_ and passes what it
+    returns up through the actions of the unit rules _units_, from
+    the innermost, the last, out; see GenericParser.removeUnitRules()."""
+
+    def chained(args):
+        node = action(args)
+        for unit in reversed(units):
+            node = unit([node])
+        return node
+
+    return chained
+
+
 def rule2str(rule):
     return ("%s ::= %s" % (rule[0], " ".join(rule[1]))).rstrip()
 
 
+# Earley items are packed into a single int: the parser state number in
+# the low _STATE_BITS bits and the index of the item's parent Earley set
+# above that.
+_STATE_BITS = 24
+_STATE_MASK = (1 << _STATE_BITS) - 1
+
+# Fully built parse state machines, keyed by grammar fingerprint, so
+# that parsers of the same grammar share one read-only copy of the
+# tables.  See GenericParser.findTables().  Only the most recently
+# used _MAX_COMPILED_TABLES are kept, since fork() and addRule() make
+# a new grammar for each change.
+_compiled_tables = OrderedDict()
+_MAX_COMPILED_TABLES = 32
+
+# Held while GenericParser.session() brings a parser's tables up to
+# date, so that threads starting sessions at once don't both build them
+_compile_lock = threading.RLock()
+
+
+def _find_compiled(fingerprint):
+    """Return the tables in _compiled_tables under _fingerprint_, or
+    None, marking them as the most recently used."""
+    with _compile_lock:
+        tables = _compiled_tables.get(fingerprint)
+        if tables is not None:
+            _compiled_tables.move_to_end(fingerprint)
+        return tables
+
+
+def _add_compiled(fingerprint, tables):
+    """Put _tables_ in _compiled_tables under _fingerprint_, dropping
+    the least recently used tables if there are too many."""
+    with _compile_lock:
+        _compiled_tables[fingerprint] = tables
+        _compiled_tables.move_to_end(fingerprint)
+        while len(_compiled_tables) > _MAX_COMPILED_TABLES:
+            _compiled_tables.popitem(last=False)
+
+
+# Numbers for the shapes of Earley sets; see GenericParser.makeSet_memo()
+_shape_ids = itertools.count()
+
+
 class _State:
     """
     Extracted from GenericParser and made global so that [un]picking works.
+
+    T and N are the terminals and nonterminals that the state has
+    transitions on.
     """
 
     def __init__(self, stateno, items):
-        self.T, self.complete, self.items = [], [], items
+        self.T, self.N, self.complete, self.items = [], [], [], items
         self.stateno = stateno
 
 
+class _EarleySet(list):
+    """
+    An Earley set.  Items are kept in a list in the order they were
+    added, since the set doubles as the worklist that makeSet() walks
+    while it is still being added to.  A hash set of the same items
+    is kept alongside it so that membership tests don't have to scan
+    the list; anything appending an item must add it to both.
+    """
+
+    __slots__ = ("members", "waiting", "leo", "shape")
+
+    def __init__(self, items=()):
+        list.__init__(self, items)
+        self.members = set(self)
+        # Completion index: nonterminal -> items that can advance over it.
+        # A set is only completed into after it is finished, so entries
+        # are filled in by makeSet() the first time they are needed, or
+        # all at once by GenericParser.freezeSets().
+        self.waiting = {}
+        # Leo's transitive items: nonterminal -> chain or None; see
+        # GenericParser.leoChain()
+        self.leo = {}
+        # The items that can still be advanced once the set is done,
+        # or None; see GenericParser.makeSet_memo()
+        self.shape = None
+
+    def __contains__(self, item):
+        if self.members is None:
+            return list.__contains__(self, item)
+        return item in self.members
+
+    def finish(self):
+        """Nothing more gets added to the set: drop the membership hash."""
+        self.members = None
+
+
+class ParseResult(object):
+    """
+    What GenericParser.parse_result() returns: the parse tree, and
+    how big a chart it took to get it.
+
+    stats has "sets", "items" and "links": the number of Earley sets,
+    of items in them, and of items with back-pointers; and "lr", which
+    is True if the LALR(1) tables parsed the input, in which case no
+    Earley sets were built; "reused", the number of Earley sets
+    reparse() took from the parse before; and "replayed", the number
+    of sets made by replaying how alike sets were made before.  chart
+    is (sets, links, leo_links) if the chart was kept, else None.
+    """
+
+    def __init__(self, tree, stats, chart=None, tokens=None, subtrees=None):
+        self.tree = tree
+        self.stats = stats
+        self.chart = chart
+        # If the chart was kept, the tokens parsed and the subtrees of
+        # the parse tree; see GenericParser.reparse()
+        self.tokens = tokens
+        self.subtrees = subtrees
+
+
+class PrefixCache(object):
+    """
+    The Earley sets of recent parses, for GenericParser.prefix_cache,
+    in a trie keyed by the types of their tokens.  The Earley sets for
+    the first n tokens of an input depend on just the types of those
+    tokens, so a parse can take over the sets of an earlier one whose
+    input starts out with the same token types.
+
+    At most _size_ parses are kept; the one used least recently is
+    dropped first.  Parsers of different grammars, and in different
+    threads, can share a cache.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        # id(edges) -> (edges, root of the trie) for each state machine
+        self.tries = {}
+        # id(chart) -> (chart, id(edges), trie path), least recently
+        # used first.  A trie node is a dict from symbol number to
+        # child node, and from None to the most recent chart through it.
+        self.charts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, edges, syms):
+        """Return (chart, n) for the cached parse with state machine
+        _edges_ whose first n token types are the longest prefix of
+        _syms_ found; (None, 0) if there is none."""
+        with self.lock:
+            trie = self.tries.get(id(edges))
+            if trie is None:
+                return None, 0
+            node, chart, n = trie[1], None, 0
+            for sym in syms:
+                # None keys the chart, and is no token type in add()
+                if sym is None:
+                    break
+                node = node.get(sym)
+                if node is None:
+                    break
+                chart = node[None]
+                n += 1
+            if chart is not None:
+                self.charts.move_to_end(id(chart))
+            return chart, n
+
+    def add(self, edges, syms, chart):
+        """Add the _chart_, (sets, links, leo_links), of a parse with
+        state machine _edges_ of tokens of types _syms_.  Symbols after
+        a None, the type of a token not in the grammar, aren't used."""
+        with self.lock:
+            trie = self.tries.get(id(edges))
+            if trie is None:
+                trie = self.tries[id(edges)] = (edges, {})
+            node, path = trie[1], []
+            for sym in syms:
+                if sym is None:
+                    break
+                parent, node = node, node.setdefault(sym, {})
+                node[None] = chart
+                path.append((parent, sym, node))
+            if not path:
+                # Nothing to look the chart up by; an empty trie may
+                # already be gone when it is evicted
+                if not trie[1]:
+                    del self.tries[id(edges)]
+                return
+            self.charts[id(chart)] = (chart, id(edges), path)
+            while len(self.charts) > self.size:
+                self.evict(self.charts.popitem(last=False)[1])
+
+    def evict(self, entry):
+        """Take the chart of _entry_ out of the trie.  Nodes that led
+        to it alone go; the others are left leading to the chart of
+        one of their children."""
+        chart, key, path = entry
+        for parent, sym, node in reversed(path):
+            if node[None] is not chart:
+                # A later chart went through here, and so through all
+                # the nodes above
+                break
+            children = [child for k, child in node.items() if k is not None]
+            if children:
+                node[None] = children[0][None]
+            else:
+                del parent[sym]
+        if not self.tries[key][1]:
+            del self.tries[key]
+
+
+async def _aiter(iterable):
+    """An async iterator over _iterable_, for parse_async()"""
+    for item in iterable:
+        yield item
+
+
 # DEFAULT_DEBUG = {'rules': True, 'transition': True, 'reduce' : True,
 #                  'errorstack': 'full', 'dups': False }
 # DEFAULT_DEBUG = {'rules': False, 'transition': False, 'reduce' : True,
@@ -88,16 +362,21 @@ class GenericParser(object):
     Parsing", unpublished paper, 2001.
     """
 
-    def __init__(self, start, debug=DEFAULT_DEBUG, coverage_path=None):
+    def __init__(self, start, debug=DEFAULT_DEBUG, coverage_path=None, cache_dir=None):
         """_start_ : grammar start symbol;
         _debug_ : produce optional parsing debug information
         _profile_ : if not None should be a file path to open
         with where to store profile is stored
+        _cache_dir_ : if not None, a directory where the fully built
+        parse state machine is saved and looked up; see compile()
         """
 
         self.rules = {}
         self.rule2func = {}
         self.rule2name = {}
+        # The functions given to addRule(), before preprocess(); fork()
+        # preprocesses them again for the copy
+        self.rule2source = {}
 
         # grammar coverage information
         self.coverage_path = coverage_path
@@ -121,12 +400,23 @@ class GenericParser(object):
         self.list_like_nt = set()
         self.optional_nt = set()
 
+        # Rules added and removed since the tables were made, used as
+        # ordered sets; see updateTables().  Tables that can be seen
+        # by other parsers are marked shared, and are copied before
+        # being changed.
+        self.added_rules, self.removed_rules = {}, {}
+        self.shared_tables = False
+
         self.collectRules()
         if start not in self.rules:
             raise TypeError('Start symbol "%s" is not in LHS of any rule' % start)
         self.augment(start)
         self.ruleschanged = True
 
+        # Set by compile() once the entire state machine has been built
+        self.compiled = False
+        self.cache_dir = cache_dir
+
         # The key is an LHS non-terminal string. The value
         # should be AST if you want to pass an AST to the routine
         # to do the checking. The routine called is
@@ -137,57 +427,360 @@ class GenericParser(object):
         self.check_reduce = {}
 
     _NULLABLE = r"\e_"
+    _TAIL = r"\t_"
     _START = "START"
     _BOF = "|-"
 
+    # Rules with more nullable symbols than this, if it is set, are
+    # split up before they are expanded into the epsilon-free grammar;
+    # see splitRule().  At least 2.
+    _MAX_NULLABLE = None
+
+    # Don't add Earley items that can't go on with the next token;
+    # see viable()
+    lookahead = True
+
+    # Unit rules, like expr ::= term, are kept when None.  Otherwise
+    # they are removed from the state machine, and in parse trees the
+    # chain of nodes they would have made is built ("chain"), or just
+    # the innermost node ("collapse").  See removeUnitRules().
+    unit_rules = None
+
+    # Leave rules that can't be part of any parse out of the state
+    # machine; see pruneRules()
+    prune_rules = False
+
+    # Keep the Earley sets and back-pointers of the last parse on the
+    # parser; see parse_result()
+    keep_chart = False
+
+    # A PrefixCache of the Earley sets of earlier parses, which parse()
+    # picks up from when the token types of its input start out the
+    # same as those of one of them.  It is only used once compile()
+    # has been called, and not with reduce_is_invalid() checks.
+    prefix_cache = None
+
+    # Replay how Earley sets were made when sets alike come up again;
+    # see makeSet_memo().  This pays on inputs that repeat themselves,
+    # like long statement lists, and costs a little on others.  At
+    # most _SET_MEMO_SIZE configurations of sets are kept, and sets
+    # that reach back through more than _SET_MEMO_REACH parent sets
+    # aren't replayed.
+    memoize_sets = False
+    _SET_MEMO_SIZE = 20000
+    _SET_MEMO_REACH = 40
+
+    # How many Earley sets the last parse replayed; see makeSet_memo()
+    replayed_sets = 0
+
+    # Let reparse() use subtrees of the old parse tree in the new one.
+    # Only set this if reduction actions don't change their arguments,
+    # as actions that collect lists into their first argument do.
+    reuse_subtrees = False
+
+    # Subtrees of the parse tree being built, if they can be reused;
+    # see buildTree()
+    subtrees = None
+
+    # The Earley sets, and the makeSet() building them, of a parse
+    # being fed its tokens; see feed()
+    feeding = None
+
+    # Parse with LALR(1) tables, falling back on the Earley parser
+    # where they have a conflict; see recognizeLR()
+    lr = False
+
+    # Jump to the end of deterministic chains of completions, which
+    # makes right recursion take linear time; see leoItem().  Where
+    # ambiguity() can't tell parses apart, the tree can differ.
+    leo = False
+
+    # The tables derived from self.rules that make up the parse state
+    # machine; see makeTables() and numberRules().  Saved in the cache
+    # directory.
+    _TABLES = (
+        "newrules",
+        "new2old",
+        "nullable",
+        "states",
+        "edges",
+        "cores",
+        "sym_names",
+        "sym2id",
+        "symbits",
+        "sym_nonterminal",
+        "sym_nullable",
+        "lhs2rules",
+        "id2rule",
+        "rule2id",
+        "rule_lhs",
+        "rule_rhs",
+        "unit_chains",
+        "pruned_rules",
+        "lr_tables",
+    )
+
+    # Bump this when the layout of the tables above changes
+    _CACHE_FORMAT = 4
+
     #
     #  When pickling, take the time to generate the full state machine;
     #  some information is then extraneous, too.  Unfortunately we
     #  can't save the rule2func map.
     #
     def __getstate__(self):
-        if self.ruleschanged:
-            #
-            #  XXX - duplicated from parse()
-            #
-            self.computeNull()
-            self.newrules = {}
-            self.new2old = {}
-            self.makeNewRules()
-            self.ruleschanged = False
-            self.edges, self.cores = {}, {}
-            self.states = {0: self.makeState0()}
-            self.makeState(0, self._BOF)
-        #
-        #  XXX - should find a better way to do this..
-        #
-        changes = True
-        while changes:
-            changes = False
-            for k, v in list(self.edges.items()):
-                if v is None:
-                    state, sym = k
-                    if state in self.states:
-                        self.goto(state, sym)
-                        changes = True
+        self.compile()
         rv = self.__dict__.copy()
-        for s in list(self.states.values()):
+        rv["states"] = states = []
+        for s in self.states:
+            s = copy.copy(s)
             del s.items
+            states.append(s)
         del rv["rule2func"]
+        del rv["rule2source"]
+        del rv["rule_action"]
         del rv["nullable"]
         del rv["cores"]
+        del rv["set_memo"]
+        del rv["set_shapes"]
         return rv
 
     def __setstate__(self, D):
         self.rules = {}
         self.rule2func = {}
         self.rule2name = {}
+        self.rule2source = {}
+        self.list_like_nt = set()
+        self.optional_nt = set()
+        self.added_rules, self.removed_rules = {}, {}
+        self.debug = D["debug"]
+        self.profile_info = None
         self.collectRules()
         start = D["rules"][self._START][0][1][1]  # Blech.
         self.augment(start)
         D["rule2func"] = self.rule2func
-        D["makeSet"] = self.makeSet_fast
+        D["rule2source"] = self.rule2source
         self.__dict__ = D
+        self.first_sets = {}
+        self.set_memo, self.set_shapes = {}, {}
+        self.lr_tables = None
+        self.makeActions()
+
+    def fork(self):
+        """Return a copy of this parser whose grammar can be changed
+        with addRule() and remove_rules() without affecting this one.
+
+        The copy starts out sharing this parser's state machine, and
+        after a grammar change, rebuilds only the states the change
+        affects; see updateTables().  So customizing the grammar of a
+        fork for each input costs roughly the size of the change.
+        """
+        # Not copy.copy(), which would go through __getstate__()
+        other = object.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other.rules = dict([(lhs, rulelist[:]) for lhs, rulelist in self.rules.items()])
+        # Reduction methods must run on the copy, and so must the
+        # functions preprocess() wraps them in
+        other.rule2func, other.rule2source = {}, {}
+        for rule, func in self.rule2func.items():
+            source = self.rule2source.get(rule)
+            if source is None:
+                if getattr(func, "__self__", None) is self:
+                    func = func.__func__.__get__(other, other.__class__)
+            else:
+                if getattr(source, "__self__", None) is self:
+                    source = source.__func__.__get__(other, other.__class__)
+                func = other.preprocess(rule, source)[1]
+            other.rule2func[rule] = func
+            other.rule2source[rule] = source
+        other.rule2name = self.rule2name.copy()
+        other.check_reduce = self.check_reduce.copy()
+        other.list_like_nt = set(self.list_like_nt)
+        other.optional_nt = set(self.optional_nt)
+        other.added_rules = self.added_rules.copy()
+        other.feeding = None
+        other.removed_rules = self.removed_rules.copy()
+        self.shared_tables = other.shared_tables = True
+        if self.profile_info is not None:
+            other.profile_info = self.profile_info.copy()
+        if getattr(self, "rule_action", None) is not None:
+            other.makeActions()
+        return other
+
+    def session(self):
+        """Return a parser for a single parse, or a series of parses
+        in one thread, that shares this parser's grammar, state
+        machine and reduction methods.
+
+        parse() keeps the Earley sets, back-pointers and tokens of a
+        parse on the parser, and before compile() it builds states as
+        it goes; so one parser can't parse in two threads at once.
+        Sessions can: the state machine is built in full before the
+        first session is handed out, so after that it is only read,
+        and each session keeps the state of its parses to itself.
+        That includes the Earley sets it memoizes (see memoize_sets)
+        and, when profiling, its own copy of the rule counts.  Only
+        the FIRST sets of states are shared; see firstSet().
+
+        Don't change the grammar of a session; fork() the parser for
+        that.  Reduction methods still run on this parser, so they
+        mustn't keep state of a parse on it either.
+        """
+        if self.ruleschanged or not self.compiled:
+            with _compile_lock:
+                self.compile()
+        # Not copy.copy(), which would go through __getstate__()
+        other = object.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other.feeding = None
+        other.set_memo, other.set_shapes = {}, {}
+        if self.profile_info is not None:
+            other.profile_info = self.profile_info.copy()
+        return other
+
+    def parse_many(self, inputs, max_workers=None):
+        """Parse each token list in _inputs_ in a pool of up to
+        _max_workers_ threads, each parse in its own session(), and
+        return the results in the order of _inputs_.  An exception
+        from any parse is raised here."""
+        self.compile()
+
+        def parse(tokens):
+            return self.session().parse(tokens)
+
+        with ThreadPoolExecutor(max_workers) as pool:
+            return list(pool.map(parse, inputs))
+
+    def compile(self):
+        """Build the entire parse state machine now rather than a
+        piece at a time as parse() needs it.  Once it is built, parse()
+        uses makeSet_fast(), which relies on all transitions being
+        known.
+
+        Call this once after the grammar is set up, e.g. at program
+        start, to pay for all of the state machine construction up
+        front.  Adding or removing rules afterwards drops the states
+        the change affects; call compile() again after that to get
+        back the fast path.
+
+        Once built, the state machine is shared with any other parser
+        of the same grammar in this process.  If self.cache_dir is set,
+        it is also looked up there under grammar_fingerprint(), and
+        saved there after it has been built.
+        """
+        if self.ruleschanged and not self.findTables():
+            if not self.updateTables():
+                self.makeTables()
+        if self.lr and self.lr_tables is None:
+            self.makeLRTables()
+            if self.compiled:
+                # Found without them; share them from now on
+                self.shareTables()
+        if self.compiled:
+            return
+        #
+        #  Resolve every pending transition.  New states are appended
+        #  to self.states as they are made, and get resolved when the
+        #  loop reaches them.
+        #
+        states = self.states
+        i = 0
+        while i < len(states):
+            state = states[i]
+            self.goto(i, 0)
+            for sym in state.T + state.N:
+                self.goto(i, sym)
+            i += 1
+        self.compiled = True
+        self.shareTables()
+
+    def shareTables(self):
+        """Make the fully built tables the ones that findTables() finds
+        for this grammar, and save them in self.cache_dir if it is set.
+        The LALR(1) tables are among them once self.lr has built them."""
+        tables = dict([(name, getattr(self, name)) for name in self._TABLES])
+        fingerprint = self.grammar_fingerprint()
+        _add_compiled(fingerprint, tables)
+        self.shared_tables = True
+        if self.cache_dir:
+            self.saveTables(tables, fingerprint)
+
+    def grammar_fingerprint(self):
+        """Return a hex string that identifies the grammar: its rules,
+        in the order they were added, and its start symbol.  Any change
+        to the grammar gives a different fingerprint.  So does pruning
+        rules, or removing unit rules, which depends on
+        self.check_reduce as well, and a different limit on nullable
+        symbols per rule."""
+        h = hashlib.sha256()
+        h.update(repr(self._CACHE_FORMAT).encode("utf-8"))
+        h.update(("nullable %s\n" % self._MAX_NULLABLE).encode("utf-8"))
+        for lhs, rulelist in self.rules.items():
+            for rule in rulelist:
+                h.update(("%r\n" % (rule,)).encode("utf-8"))
+        if self.prune_rules:
+            h.update("prune\n".encode("utf-8"))
+        if self.unit_rules:
+            h.update(("%r\n" % (sorted(self.check_reduce),)).encode("utf-8"))
+        return h.hexdigest()
+
+    def cachePath(self, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = self.grammar_fingerprint()
+        return os.path.join(self.cache_dir, "spark-%s.pickle" % fingerprint)
+
+    def findTables(self):
+        """Set up a fully built state machine for the current grammar
+        without building it: either one that another parser in this
+        process has built, or one saved in self.cache_dir.  Return True
+        if one was found.
+
+        The tables are shared and must not be changed; this is fine
+        since they are complete, and a grammar change replaces rather
+        than updates them.
+        """
+        fingerprint = self.grammar_fingerprint()
+        tables = _find_compiled(fingerprint)
+        if tables is None:
+            if not self.cache_dir:
+                return False
+            tables = self.loadTables(fingerprint)
+            if tables is None:
+                return False
+            _add_compiled(fingerprint, tables)
+        self.__dict__.update(tables)
+        self.first_sets = {}
+        self.set_memo, self.set_shapes = {}, {}
+        self.makeActions()
+        self.ruleschanged = False
+        self.compiled = True
+        self.added_rules, self.removed_rules = {}, {}
+        self.shared_tables = True
+        return True
+
+    def loadTables(self, fingerprint=None):
+        """Return the state machine tables saved in self.cache_dir for
+        this grammar, or None if there aren't any."""
+        try:
+            with open(self.cachePath(fingerprint), "rb") as fp:
+                return pickle.load(fp)
+        except Exception:
+            # A missing, truncated or stale cache file is just a miss
+            return None
+
+    def saveTables(self, tables, fingerprint=None):
+        """Save the fully built state machine in self.cache_dir.  Not
+        being able to write there isn't an error; the cache is only an
+        optimization."""
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(tables, fp, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cachePath(fingerprint))
+        except OSError:
+            pass
 
     #
     #  A hook for GenericASTBuilder and GenericASTMatcher.  Mess
@@ -208,23 +801,8 @@ class GenericParser(object):
         """
         fn = func
 
-        # remove blanks lines and comment lines, e.g. lines starting with "#"
-        doc = os.linesep.join(
-            [s for s in doc.splitlines() if s and not re.match(r"^\s*#", s)]
-        )
-
-        rules = doc.split()
-
-        index = []
-        for i in range(len(rules)):
-            if rules[i] == "::=":
-                index.append(i - 1)
-        index.append(len(rules))
-
-        for i in range(len(index) - 1):
-            lhs = rules[index[i]]
-            rhs = rules[index[i] + 2 : index[i + 1]]
-            rule = (lhs, tuple(rhs))
+        for rule in _parse_rules(doc):
+            lhs = rule[0]
 
             if _preprocess:
                 rule, fn = self.preprocess(rule, func)
@@ -256,7 +834,7 @@ class GenericParser(object):
                     continue
 
             if lhs in self.rules:
-                if rule in self.rules[lhs]:
+                if rule in self.rule2func:
                     if "dups" in self.debug and self.debug["dups"]:
                         self.duplicate_rule(rule)
                     continue
@@ -264,8 +842,13 @@ class GenericParser(object):
             else:
                 self.rules[lhs] = [rule]
             self.rule2func[rule] = fn
+            self.rule2source[rule] = func if _preprocess else None
             self.rule2name[rule] = func.__name__[2:]
             self.ruleschanged = True
+            if rule in self.removed_rules:
+                del self.removed_rules[rule]
+            else:
+                self.added_rules[rule] = True
 
             # Note: In empty rules, i.e. len(rule[1] == 0, we don't
             # call reductions on explicitly. Instead it is computed
@@ -281,30 +864,22 @@ class GenericParser(object):
         """Remove a grammar rules from  _self.rules_, _self.rule2func_,
         and _self.rule2name_
         """
-        # remove blanks lines and comment lines, e.g. lines starting with "#"
-        doc = os.linesep.join(
-            [s for s in doc.splitlines() if s and not re.match(r"^\s*#", s)]
-        )
-
-        rules = doc.split()
-        index = []
-        for i in range(len(rules)):
-            if rules[i] == "::=":
-                index.append(i - 1)
-        index.append(len(rules))
-        for i in range(len(index) - 1):
-            lhs = rules[index[i]]
-            rhs = rules[index[i] + 2 : index[i + 1]]
-            rule = (lhs, tuple(rhs))
+        for rule in _parse_rules(doc):
+            lhs = rule[0]
 
             if lhs not in self.rules:
                 return
 
-            if rule in self.rules[lhs]:
+            if rule in self.rule2func:
                 self.rules[lhs].remove(rule)
                 del self.rule2func[rule]
                 del self.rule2name[rule]
+                self.rule2source.pop(rule, None)
                 self.ruleschanged = True
+                if rule in self.added_rules:
+                    del self.added_rules[rule]
+                else:
+                    self.removed_rules[rule] = True
 
                 # If we are profiling, remove this rule from that as well
                 if self.profile_info is not None and len(rule[1]) > 0:
@@ -320,33 +895,51 @@ class GenericParser(object):
     remove_rule = remove_rules
 
     def collectRules(self):
-        for name in _namelist(self):
-            if name[:2] == "p_":
-                func = getattr(self, name)
-                doc = func.__doc__
-                self.addRule(doc, func)
+        cls = self.__class__
+        names = _rule_methods.get(cls)
+        if names is None:
+            names = _rule_methods[cls] = [
+                name for name in _namelist(self) if name[:2] == "p_"
+            ]
+        for name in names:
+            func = getattr(self, name)
+            doc = func.__doc__
+            # Parsed once per class; addRule() finds it in the cache
+            _parse_rules(doc, True)
+            self.addRule(doc, func)
 
     def augment(self, start):
         rule = "%s ::= %s %s" % (self._START, self._BOF, start)
         self.addRule(rule, lambda args: args[1], False)
 
     def computeNull(self):
-        self.nullable = {}
-        tbd = []
-
-        for rulelist in list(self.rules.values()):
-            # FIXME: deleting a rule may leave a null entry.
-            # Perhaps we should improve deletion so it doesn't leave a trace?
-            if not rulelist:
-                continue
-
-            lhs = rulelist[0][0]
+        """
+        Set self.nullable[lhs] to 1 for each nonterminal that can
+        derive the empty string, and to 0 for the others.
+
+        Each rule that consists entirely of nonterminal symbols keeps
+        a count of the symbols on its rhs not yet known to be nullable.
+        When a nonterminal turns out to be nullable, the counts of the
+        rules that use it go down, and a rule whose count reaches 0
+        makes its lhs nullable in turn.  So each rule is looked at only
+        once per symbol on its rhs.
+        """
+        nullable = self.nullable = {}
+        for lhs, rulelist in self.rules.items():
+            # Deleting all of the rules of a nonterminal leaves an
+            # empty list behind; the nonterminal is gone.
+            if rulelist:
+                nullable[lhs] = 0
 
-            self.nullable[lhs] = 0
-            for rule in rulelist:
-                rhs = rule[1]
+        worklist = []
+        pending, pending_lhs = [], []
+        users = {}
+        for rulelist in self.rules.values():
+            for lhs, rhs in rulelist:
                 if len(rhs) == 0:
-                    self.nullable[lhs] = 1
+                    if not nullable[lhs]:
+                        nullable[lhs] = 1
+                        worklist.append(lhs)
                     continue
                 #
                 #  We only need to consider rules which
@@ -355,26 +948,29 @@ class GenericParser(object):
                 #  grammars.
                 #
                 for sym in rhs:
-                    if sym not in self.rules:
+                    if sym not in nullable:
                         break
                 else:
-                    tbd.append(rule)
-        changes = 1
-        while changes:
-            changes = 0
-            for lhs, rhs in tbd:
-                if self.nullable[lhs]:
-                    continue
-                for sym in rhs:
-                    if not self.nullable[sym]:
-                        break
-                else:
-                    self.nullable[lhs] = 1
-                    changes = 1
+                    for sym in rhs:
+                        if sym in users:
+                            users[sym].append(len(pending))
+                        else:
+                            users[sym] = [len(pending)]
+                    pending.append(len(rhs))
+                    pending_lhs.append(lhs)
+
+        while worklist:
+            for i in users.get(worklist.pop(), ()):
+                pending[i] -= 1
+                if pending[i] == 0:
+                    lhs = pending_lhs[i]
+                    if not nullable[lhs]:
+                        nullable[lhs] = 1
+                        worklist.append(lhs)
 
     def makeState0(self):
         s0 = _State(0, [])
-        for rule in self.newrules[self._START]:
+        for rule in self.lhs2rules[self.sym2id[self._START]]:
             s0.items.append((rule, 0))
         return s0
 
@@ -385,22 +981,290 @@ class GenericParser(object):
         if len(self.newrules[self._START]) == 2 and len(tokens) == 0:
             return 1
         start = self.rules[self._START][0][1][1]
-        return self.goto(1, start)
+        return self.goto(1, self.sym2id[start])
+
+    def makeTables(self):
+        """
+        Compute from self.rules everything the parser runs on: the
+        nullable nonterminals, the epsilon-free grammar in
+        self.newrules, its integer encoding, and the start of the
+        state machine.  The rest of the state machine is filled in
+        lazily by goto().
+        """
+        self.computeNull()
+        self.newrules = {}
+        self.new2old = {}
+        self.makeNewRules()
+        self.pruned_rules = []
+        if self.prune_rules:
+            self.pruneRules()
+        self.unit_chains = {}
+        if self.unit_rules:
+            self.removeUnitRules()
+        self.numberRules()
+        self.ruleschanged = False
+        self.compiled = False
+        self.added_rules, self.removed_rules = {}, {}
+        self.shared_tables = False
+        self.edges, self.cores = {}, {}
+        self.first_sets = {}
+        self.set_memo, self.set_shapes = {}, {}
+        self.lr_tables = None
+        self.states = [self.makeState0()]
+        self.makeState(0, self.sym2id[self._BOF])
+
+    def updateTables(self):
+        """
+        Bring tables built by makeTables() up to date after rules have
+        been added or removed, keeping the states that the change
+        doesn't affect.  Symbols and rules keep their numbers; new
+        ones are numbered after them.  Return False if there are no
+        tables yet, or if the change is one that needs makeTables():
+        one to the START rule, one that turns a terminal into a
+        nonterminal or the other way around, or one that needs wider
+        symbol numbers.
+
+        Tables that may be shared with other parsers (see fork() and
+        findTables()) are copied before they are changed.
+        """
+        if getattr(self, "cores", None) is None or self.unit_rules or self.prune_rules:
+            # No tables, or unpickled ones that lack what's needed.
+            # pruneRules() and removeUnitRules() aren't done
+            # incrementally.
+            return False
+        if self.shared_tables:
+            self.copyTables()
+        try:
+            added, removed, reordered = self.updateNewRules()
+        except Exception:
+            # Don't leave half-updated tables behind
+            self.cores = None
+            raise
+        changed = set([lhs for lhs, rhs in added + removed]) | reordered
+        newsyms = []
+        for lhs, rhs in added:
+            for sym in (lhs,) + rhs:
+                if sym not in self.sym2id and sym not in newsyms:
+                    newsyms.append(sym)
+        # An \e_ or tail nonterminal that loses all its rules is no
+        # longer used anywhere, so it can stay a nonterminal without rules
+        flipped = [
+            sym
+            for sym in changed
+            if sym in self.sym2id
+            and not (self.isnullable(sym) or self.istail(sym))
+            and self.sym_nonterminal[self.sym2id[sym]] != (sym in self.newrules)
+        ]
+        nsyms = len(self.sym_names) + len(newsyms)
+        if self._START in changed or flipped or nsyms.bit_length() != self.symbits:
+            # Don't leave half-updated tables behind
+            self.cores = None
+            return False
+
+        sym2id, rule2id = self.sym2id, self.rule2id
+        for sym in newsyms:
+            sym2id[sym] = len(self.sym_names)
+            self.sym_names.append(sym)
+            self.sym_nonterminal.append(sym in self.newrules)
+            self.sym_nullable.append(self.isnullable(sym))
+            self.lhs2rules.append([])
+        for rule in removed:
+            del rule2id[rule]
+        for rule in added:
+            rule2id[rule] = len(self.id2rule)
+            self.id2rule.append(rule)
+            self.rule_lhs.append(sym2id[rule[0]])
+            self.rule_rhs.append(tuple([sym2id[sym] for sym in rule[1]]))
+        for lhs in changed:
+            self.lhs2rules[sym2id[lhs]] = [
+                rule2id[rule] for rule in self.newrules.get(lhs, [])
+            ]
+        self.makeActions()
+
+        #
+        #  A kernel state depends only on its items, but a nonkernel
+        #  state is all the rules of the nonterminals it predicts.
+        #  Forget those that predict a changed nonterminal, and
+        #  recompute the nonkernel states of the kernel states that
+        #  led to them when they are next needed.
+        #
+        changed = set([sym2id[lhs] for lhs in changed])
+        cores, edges = self.cores, self.edges
+        stale = set()
+        for core, state in list(cores.items()):
+            if isinstance(core[0], int) and not changed.isdisjoint(core):
+                del cores[core]
+                stale.add(state)
+        if stale:
+            shift = self.symbits
+            for state in range(len(self.states)):
+                if edges.get(state << shift) in stale:
+                    edges[state << shift] = None
+        self.first_sets = {}
+        self.set_memo, self.set_shapes = {}, {}
+        self.lr_tables = None
+        self.ruleschanged = False
+        self.compiled = False
+        return True
+
+    def copyTables(self):
+        """Give this parser its own copy of its tables, so that
+        updateTables() can change them in place."""
+        for name in self._TABLES:
+            table = getattr(self, name)
+            if name == "newrules":
+                table = dict([(lhs, rulelist[:]) for lhs, rulelist in table.items()])
+            elif not isinstance(table, (int, tuple, type(None))):
+                table = table.copy()
+            setattr(self, name, table)
+        self.shared_tables = False
+
+    def updateNewRules(self):
+        """
+        Update self.nullable, self.newrules and self.new2old for the
+        rules added to and removed from self.rules since they were
+        computed.  Only the changed rules are expanded again, unless
+        the change alters which nonterminals are nullable; then so
+        are the rules that use those nonterminals.  Return the lists
+        of rules of the epsilon-free grammar that were added and
+        removed, and the set of nonterminals whose rules were put
+        back in order.
+        """
+        added, removed = self.added_rules, self.removed_rules
+        nullable = old_nullable = self.nullable
+
+        #
+        #  Adding rules can only make nonterminals nullable, and
+        #  removing them can only make them not nullable.
+        #
+        renull = False
+        for lhs, rhs in removed:
+            if nullable.get(lhs):
+                renull = True
+        for lhs, rhs in added:
+            if not nullable.get(lhs):
+                for sym in rhs:
+                    if not nullable.get(sym):
+                        break
+                else:
+                    renull = True
+        if renull:
+            self.computeNull()
+            nullable = self.nullable
+            flipped = set(
+                [
+                    sym
+                    for sym in set(nullable) | set(old_nullable)
+                    if bool(nullable.get(sym)) != bool(old_nullable.get(sym))
+                ]
+            )
+        else:
+            flipped = ()
+            for lhs, rhs in list(added) + list(removed):
+                if self.rules.get(lhs):
+                    nullable[lhs] = nullable.get(lhs, 0)
+                elif lhs in nullable:
+                    del nullable[lhs]
+
+        rules = list(removed) + list(added)
+        if flipped:
+            for rulelist in self.rules.values():
+                for rule in rulelist:
+                    if rule not in added and not flipped.isdisjoint(rule[1]):
+                        rules.append(rule)
+
+        newrules, new2old = self.newrules, self.new2old
+        gone, new = [], []
+        for rule in rules:
+            if rule not in added:
+                for newrule in self.expandRule(rule, old_nullable):
+                    lhs = newrule[0]
+                    newrules[lhs].remove(newrule)
+                    if not newrules[lhs]:
+                        del newrules[lhs]
+                    del new2old[newrule]
+                    gone.append(newrule)
+            if rule not in removed:
+                for newrule in self.expandRule(rule, nullable):
+                    lhs = newrule[0]
+                    if lhs in newrules:
+                        newrules[lhs].append(newrule)
+                    else:
+                        newrules[lhs] = [newrule]
+                    new2old[newrule] = rule
+                    new.append(newrule)
+        self.added_rules, self.removed_rules = {}, {}
+
+        #
+        #  New rules went on the end of their lists.  Put the lists of
+        #  the nonterminals they came from back in the order that
+        #  makeNewRules() gives, so that ties in ambiguity() go the
+        #  same way as after a full rebuild.
+        #
+        reordered = set()
+        for base in set([rule[0] for rule in rules]):
+            expanded = []
+            for rule in self.rules.get(base, []):
+                for newrule in self.expandRule(rule, nullable):
+                    expanded.append((newrule, rule))
+            for newrule, rule in self.orderNewRules(expanded):
+                lhs = newrule[0]
+                if lhs not in reordered:
+                    reordered.add(lhs)
+                    newrules[lhs] = []
+                newrules[lhs].append(newrule)
+
+        rule2id = self.rule2id
+        return (
+            [rule for rule in new if rule not in rule2id],
+            [rule for rule in gone if rule not in new2old],
+            reordered,
+        )
+
+    def orderNewRules(self, expanded):
+        """
+        Sort the (newrule, rule) pairs in _expanded_, rules of the
+        epsilon-free grammar and the rules they came from, into the
+        order of one worklist over all the rules: every rule, then the
+        rules with one nullable symbol left out, and so on.  Ties in
+        ambiguity() go by this order.  Return the sorted list.
+        """
+        nullable = self._NULLABLE
+        expanded.sort(key=lambda r: len([s for s in r[0][1] if s.startswith(nullable)]))
+        return expanded
 
     def makeNewRules(self):
-        worklist = []
+        expanded = []
         for rulelist in list(self.rules.values()):
             for rule in rulelist:
-                worklist.append((rule, 0, 1, rule))
-
-        for rule, i, candidate, oldrule in worklist:
+                for newrule in self.expandRule(rule, self.nullable):
+                    expanded.append((newrule, rule))
+        for newrule, rule in self.orderNewRules(expanded):
+            lhs = newrule[0]
+            if lhs in self.newrules:
+                self.newrules[lhs].append(newrule)
+            else:
+                self.newrules[lhs] = [newrule]
+            self.new2old[newrule] = rule
+
+    def expandRule(self, rule, nullable):
+        """Return the rules of the epsilon-free grammar made from _rule_
+        given the _nullable_ nonterminals: one for each way of leaving
+        out nullable symbols, which are replaced by their \\e_ form.
+        A rule all of whose symbols are left out is a rule for the
+        \\e_ form of its lhs.
+
+        That is 2**k rules for a rule with k nullable symbols, so if
+        self._MAX_NULLABLE is set, a rule with more than that many of
+        them is first split up; see splitRule()."""
+        pieces, nulltails = self.splitRule(rule, nullable)
+        worklist = [(piece, 0, 1) for piece in pieces]
+        for rule, i, candidate in worklist:
             lhs, rhs = rule
             n = len(rhs)
             while i < n:
                 sym = rhs[i]
-                if sym not in self.rules or not (
-                    sym in self.nullable and self.nullable[sym]
-                ):
+                if not (nullable.get(sym) or sym in nulltails):
                     candidate = 0
                     i += 1
                     continue
@@ -408,18 +1272,303 @@ class GenericParser(object):
                 newrhs = list(rhs)
                 newrhs[i] = self._NULLABLE + sym
                 newrule = (lhs, tuple(newrhs))
-                worklist.append((newrule, i + 1, candidate, oldrule))
+                worklist.append((newrule, i + 1, candidate))
                 candidate = 0
                 i = i + 1
             else:
                 if candidate:
                     lhs = self._NULLABLE + lhs
                     rule = (lhs, rhs)
-                if lhs in self.newrules:
-                    self.newrules[lhs].append(rule)
+                yield rule
+
+    def pruneRules(self):
+        """
+        Remove from self.newrules the rules that can't be part of any
+        parse: those whose lhs can't be reached from the start symbol,
+        and those with a symbol on the rhs that can't derive a string
+        of tokens.  A symbol without rules that starts with a lowercase
+        letter is taken to be a nonterminal that was never defined, as
+        check_sets() does; any other is a token.
+
+        Grammar rules none of whose expansions are left are listed in
+        self.pruned_rules, and shown with pruned_rule() when
+        self.debug["prune"] is set.  If that is all the rules of the
+        start symbol, or all but its empty one, the start symbol is
+        left without rules, so that parse() reports a syntax error for
+        any input it can't derive, as it does without pruning.
+        """
+        newrules = self.newrules
+
+        def useful(rhs, defined):
+            for sym in rhs:
+                if sym not in defined and (sym in newrules or sym[:1].islower()):
+                    return False
+            return True
+
+        #
+        #  Productive nonterminals, as in computeNull(): each rule
+        #  counts the nonterminals on its rhs not yet known to be
+        #  productive.
+        #
+        productive = set()
+        worklist = []
+        pending, pending_lhs = [], []
+        users = {}
+        for rulelist in newrules.values():
+            for lhs, rhs in rulelist:
+                if not useful(rhs, newrules):
+                    # Uses a nonterminal that has no rules
+                    continue
+                syms = [sym for sym in rhs if sym in newrules]
+                if not syms:
+                    if lhs not in productive:
+                        productive.add(lhs)
+                        worklist.append(lhs)
+                    continue
+                for sym in syms:
+                    if sym in users:
+                        users[sym].append(len(pending))
+                    else:
+                        users[sym] = [len(pending)]
+                pending.append(len(syms))
+                pending_lhs.append(lhs)
+        while worklist:
+            for i in users.get(worklist.pop(), ()):
+                pending[i] -= 1
+                if pending[i] == 0 and pending_lhs[i] not in productive:
+                    productive.add(pending_lhs[i])
+                    worklist.append(pending_lhs[i])
+
+        reachable = set([self._START])
+        worklist = [self._START]
+        while worklist:
+            for rule in newrules[worklist.pop()]:
+                if useful(rule[1], productive):
+                    for sym in rule[1]:
+                        if sym in newrules and sym not in reachable:
+                            reachable.add(sym)
+                            worklist.append(sym)
+
+        kept = set()
+        start = self.rules[self._START][0][1][1]
+        for lhs in list(newrules.keys()):
+            if lhs == self._START:
+                rulelist = newrules[lhs]
+            elif lhs in reachable:
+                rulelist = [rule for rule in newrules[lhs] if useful(rule[1], productive)]
+            else:
+                rulelist = []
+            for rule in newrules[lhs]:
+                if rule in rulelist:
+                    kept.add(self.new2old[rule])
                 else:
-                    self.newrules[lhs] = [rule]
-                self.new2old[rule] = oldrule
+                    del self.new2old[rule]
+            if rulelist:
+                newrules[lhs] = rulelist
+            elif lhs == start:
+                # A nonterminal with no rules, not a token of that name
+                newrules[lhs] = []
+            else:
+                del newrules[lhs]
+
+        for rulelist in self.rules.values():
+            for rule in rulelist:
+                if rule not in kept:
+                    self.pruned_rules.append(rule)
+                    if "prune" in self.debug and self.debug["prune"]:
+                        self.pruned_rule(rule)
+
+    def removeUnitRules(self):
+        """
+        Remove the unit rules, those like a ::= b whose rhs is a single
+        nonterminal, from self.newrules.  Instead, a gets a copy of each
+        rule of b, and of any nonterminal b leads to by unit rules:
+
+            a ::= b             becomes      a ::= x y
+            b ::= x y                        b ::= x y
+
+        So after x y, one Earley item completes a, instead of a chain
+        of items completing b and then a.  self.unit_chains maps each
+        copy to the rules it stands for, outermost first, so that the
+        parse tree can still have the nodes of the unit rules; see
+        makeActions().
+
+        A copy can only stand for one way of deriving its rhs.  So if
+        there is more than one, because a nonterminal is reached by
+        more than one chain of unit rules, or a copy would have the
+        same rhs as another rule of a, the unit rules of a are left in
+        place, for ambiguity() to choose among as usual.  \\e_ and
+        tail nonterminals, and nonterminals in self.check_reduce, whose
+        reductions have to be checked one at a time, are left alone.
+        """
+        newrules, new2old, chains = self.newrules, self.new2old, self.unit_chains
+        keep = set(self.check_reduce)
+        keep.add(self._START)
+
+        def isunit(rule):
+            lhs, rhs = rule
+            return (
+                len(rhs) == 1
+                and rhs[0] in newrules
+                and lhs not in keep
+                and rhs[0] not in keep
+                and not (self.isnullable(lhs) or self.istail(lhs))
+                and not (self.isnullable(rhs[0]) or self.istail(rhs[0]))
+            )
+
+        for lhs in list(newrules.keys()):
+            units = [rule for rule in newrules[lhs] if isunit(rule)]
+            if not units:
+                continue
+            rulelist = [rule for rule in newrules[lhs] if not isunit(rule)]
+            have = set(rulelist)
+            seen = set([lhs])
+            copies = []
+            worklist = [(unit, [unit]) for unit in units]
+            for unit, path in worklist:
+                sym = unit[1][0]
+                if sym in seen:
+                    break
+                seen.add(sym)
+                for rule in newrules[sym]:
+                    if isunit(rule):
+                        worklist.append((rule, path + [rule]))
+                        continue
+                    newrule = (lhs, rule[1])
+                    if newrule in have:
+                        break
+                    have.add(newrule)
+                    copies.append((newrule, rule, path))
+                else:
+                    continue
+                break
+            else:
+                for newrule, rule, path in copies:
+                    rulelist.append(newrule)
+                    new2old[newrule] = new2old[rule]
+                    chains[newrule] = path + chains.get(rule, [rule])
+                newrules[lhs] = rulelist
+
+    def splitRule(self, rule, nullable):
+        """
+        Return _rule_ split into rules with at most self._MAX_NULLABLE
+        nullable symbols each, given the _nullable_ nonterminals, and
+        the set of nonterminals made up for the split that are nullable.
+
+        The rhs is cut before a nullable symbol, and the part after the
+        cut is replaced by a new \\t_ ("tail") nonterminal with that
+        part as its only rule:
+
+            a ::= b1 ... bn
+        becomes
+            a ::= b1 ... bi-1 \\t_i
+            \\t_i ::= bi ... bn
+
+        and so on for the tail.  The tail's name includes the cut and
+        the whole rule, so no two rules share one.  Tails don't show
+        up in parse trees; see makeActions().
+
+        Where the input fits the nullable symbols of the rule in more
+        than one way, ambiguity() chooses for each piece on its own, so
+        the tree can differ from that of the whole rule.  That's why
+        rules are only split when self._MAX_NULLABLE is set.
+        """
+        lhs, rhs = rule
+        limit = self._MAX_NULLABLE
+        if limit is None:
+            return [rule], ()
+        if limit < 2:
+            # A cut must leave fewer nullable symbols in the tail
+            raise ValueError("_MAX_NULLABLE must be at least 2, not %r" % limit)
+        positions = [i for i in range(len(rhs)) if nullable.get(rhs[i])]
+        if len(positions) <= limit:
+            return [rule], ()
+
+        pieces, nulltails = [], set()
+        start = 0
+        while len(positions) > limit:
+            cut = positions[limit - 1]
+            tail = "%s%d %s" % (self._TAIL, cut, rule2str(rule))
+            pieces.append((lhs, rhs[start:cut] + (tail,)))
+            positions = positions[limit - 1 :]
+            if len(positions) == len(rhs) - cut:
+                nulltails.add(tail)
+            lhs, start = tail, cut
+        pieces.append((lhs, rhs[start:]))
+        return pieces, nulltails
+
+    def numberRules(self):
+        """
+        Number the symbols and rules of self.newrules with small ints.
+        The state machine and the parser's inner loops work only on
+        these numbers:
+
+          self.sym_names[sym]       name of symbol number sym. Number 0
+                                    is reserved for the epsilon transition
+                                    to a nonkernel state
+          self.id2rule[rule]        (lhs, rhs) names of rule number rule
+          self.rule_lhs[rule]       symbol number of the rule's lhs
+          self.rule_rhs[rule]       tuple of symbol numbers of its rhs
+          self.lhs2rules[sym]       numbers of the rules for nonterminal sym
+          self.sym_nonterminal[sym] 1 if sym has rules, 0 for a terminal
+          self.sym_nullable[sym]    1 for a nullable (\\e_) nonterminal
+
+        Transitions are kept in self.edges under the single int
+        (state << self.symbits) | sym.
+        """
+        symbols = self.sym_names = [None]
+        sym2id = self.sym2id = {None: 0}
+        for lhs, rulelist in self.newrules.items():
+            for sym in [lhs] + [sym for rule in rulelist for sym in rule[1]]:
+                if sym not in sym2id:
+                    sym2id[sym] = len(symbols)
+                    symbols.append(sym)
+
+        nsyms = len(symbols)
+        self.symbits = nsyms.bit_length()
+        self.sym_nonterminal = bytearray(nsyms)
+        self.sym_nullable = bytearray(nsyms)
+        self.lhs2rules = [[] for sym in symbols]
+        self.id2rule, self.rule2id = [], {}
+        self.rule_lhs, self.rule_rhs = [], []
+        for lhs, rulelist in self.newrules.items():
+            lhs_id = sym2id[lhs]
+            self.sym_nonterminal[lhs_id] = 1
+            self.sym_nullable[lhs_id] = self.isnullable(lhs)
+            for rule in rulelist:
+                self.lhs2rules[lhs_id].append(len(self.id2rule))
+                self.rule2id[rule] = len(self.id2rule)
+                self.id2rule.append(rule)
+                self.rule_lhs.append(lhs_id)
+                self.rule_rhs.append(tuple([sym2id[sym] for sym in rule[1]]))
+        self.makeActions()
+
+    def makeActions(self):
+        """
+        Map each rule number to the function called to build its tree
+        node, so that buildTree() doesn't need to go through
+        self.new2old and self.rule2func.
+        """
+        rule2func, new2old = self.rule2func, self.new2old
+        self.rule_action = actions = []
+        for rule in self.id2rule:
+            lhs, rhs = rule
+            if rule not in new2old:
+                # Rules removed by updateTables() keep their numbers,
+                # but no longer have an action
+                actions.append(None)
+                continue
+            if self.istail(lhs):
+                # A tail split off by splitRule() is just its symbols
+                action = list
+            else:
+                action = rule2func[new2old[rule]]
+            if rhs and self.istail(rhs[-1]):
+                action = _splice(action)
+            if rule in self.unit_chains and self.unit_rules != "collapse":
+                units = self.unit_chains[rule][:-1]
+                action = _chain([rule2func[new2old[unit]] for unit in units], action)
+            actions.append(action)
 
     def typestring(self, token):
         return None
@@ -427,6 +1576,9 @@ class GenericParser(object):
     def duplicate_rule(self, rule):
         print("Duplicate rule:\n\t%s" % rule2str(rule))
 
+    def pruned_rule(self, rule):
+        print("Pruned rule:\n\t%s" % rule2str(rule))
+
     def error(self, tokens, index):
         print("Syntax error at or near token %d: `%s'" % (index, tokens[index]))
 
@@ -453,7 +1605,7 @@ class GenericParser(object):
             # Find rules which can follow, but keep only
             # the part before the dot
             for rule, dot in self.states[state].items:
-                lhs, rhs = rule
+                lhs, rhs = self.id2rule[rule]
                 if dot > 0:
                     if full:
                         state_stack.add(
@@ -472,39 +1624,148 @@ class GenericParser(object):
         """This is the main entry point from outside.
 
         Passing in a debug dictionary changes the default debug
-        setting.
+        setting.  Returns the parse tree; see parse_result() for
+        more about the parse.
         """
-
-        self.tokens = tokens
+        return self.parse_result(tokens, debug).tree
+
+    def parse_result(self, tokens, debug=None, keep_chart=None):
+        """Parse _tokens_ as parse() does, and return a ParseResult
+        with the parse tree and the size of the Earley sets built.
+
+        The Earley sets and back-pointers take far more memory than
+        the tree, so they are dropped from the parser once the tree
+        is built, or parsing fails.  If _keep_chart_, or when it is
+        None, self.keep_chart, is set, they are kept instead, in the
+        result's chart and in self.links and self.leo_links, until
+        the next parse.
+        """
+        if keep_chart is None:
+            keep_chart = self.keep_chart
+        return self.makeResult(self.parseSets, (tokens, debug), keep_chart)
+
+    def reparse(self, result, start, end, tokens):
+        """Parse the input of _result_ again, after tokens[start:end]
+        of it have been replaced by _tokens_, and return a ParseResult
+        for the new input.
+
+        _result_ must come from parse_result() or reparse() of this
+        parser, with its chart kept.  The Earley sets before the edit
+        are taken from it as they are.  Past the edit, sets are built
+        again only until one comes out the same as in _result_, but
+        for the shift in token positions; the rest are taken from
+        _result_ too.  Where reduce_is_invalid() checks reductions,
+        which may span the edit, the sets are all built again.
+
+        The parse tree is built anew, unless self.reuse_subtrees is
+        set: subtrees of the old tree that lie wholly within Earley sets
+        taken over from _result_ are then put in the new tree as they
+        are.
+
+        The chart of the new result is kept, so that it can be
+        reparsed in turn.  If _result_ has no Earley sets, since the
+        LALR(1) tables parsed it, the new input is parsed from scratch.
+        """
+        if result.tokens is None:
+            raise TypeError("reparse() needs a result whose chart was kept")
+        if not 0 <= start <= end <= len(result.tokens):
+            raise IndexError("edit %d:%d is out of range" % (start, end))
+        if result.chart is None or start == 0 or self.ruleschanged:
+            new_tokens = list(result.tokens[:start]) + list(tokens)
+            new_tokens += result.tokens[end:]
+            return self.parse_result(new_tokens, keep_chart=True)
+        return self.makeResult(self.reparseSets, (result, start, end, tokens), True)
+
+    def makeResult(self, parse, args, keep_chart):
+        """Return the ParseResult of parse(*args), which is
+        parseSets() or reparseSets(), dropping the chart unless
+        _keep_chart_."""
+        self.reused_sets = self.replayed_sets = 0
+        self.subtrees = {} if keep_chart and self.reuse_subtrees else None
+        try:
+            tree, sets = parse(*args)
+            stats = {"lr": sets is None, "sets": 0, "items": 0, "links": 0}
+            stats["reused"] = self.reused_sets
+            stats["replayed"] = self.replayed_sets
+            chart = None
+            tokens = self.tokens if keep_chart else None
+            if sets is not None:
+                stats["sets"] = len(sets)
+                stats["items"] = sum([len(set) for set in sets])
+                stats["links"] = sum([len(links) for links in self.links])
+                if keep_chart:
+                    chart = (sets, self.links, self.leo_links)
+            subtrees = self.subtrees
+        finally:
+            if not keep_chart:
+                self.tokens = self.links = self.leo_links = None
+            self.subtrees = None
+        return ParseResult(tree, stats, chart, tokens, subtrees)
+
+    def parseSets(self, tokens, debug=None):
+        """Do the work of parse_result(): return the parse tree, and
+        the Earley sets, or None if the LALR(1) tables parsed
+        _tokens_."""
 
         if debug:
             self.debug = debug
 
-        sets = [[(1, 0), (2, 0)]]
-        self.links = {}
-
-        if self.ruleschanged:
-            self.computeNull()
-            self.newrules = {}
-            self.new2old = {}
-            self.makeNewRules()
-            self.ruleschanged = False
-            self.edges, self.cores = {}, {}
-            self.states = {0: self.makeState0()}
-            self.makeState(0, self._BOF)
+        sets = self.startSets(tokens)
+
+        if (
+            self.lr
+            and self.profile_info is None
+            and not self.debug.get("rules")
+            and not self.debug.get("reduce")
+        ):
+            derivation = self.recognizeLR(tokens)
+            if derivation is not None:
+                return self.replayLR(derivation, tokens, 0)[0], None
+
+        cache, syms = self.prefix_cache, None
+        if (
+            cache is not None
+            and self.compiled
+            and not self.reduce_checked
+            and self.profile_info is None
+            and not self.debug.get("rules")
+            and not self.debug.get("reduce")
+        ):
+            syms = [self.tokenSym(token) for token in tokens]
+            chart, n = cache.lookup(self.edges, syms)
+            if n:
+                # The back-pointers are copied, since buildTree() adds
+                # to them
+                old_sets, links, leo_links = chart
+                links = [dict(d) for d in links[:n]]
+                leo_links = [dict(d) for d in leo_links[:n]]
+                old_length = len(old_sets) - 2
+                tree, sets = self.resumeSets(
+                    tokens, (old_sets, links, leo_links), old_length, n, old_length
+                )
+                self.freezeSets(sets)
+                cache.add(self.edges, syms, (sets, self.links, self.leo_links))
+                return tree, sets
+
+        makeSet = self.setMaker()
 
         i = 0
         for i in range(len(tokens)):
-            sets.append([])
+            sets.append(_EarleySet())
+            self.links.append({})
+            self.leo_links.append({})
 
-            if sets[i] == []:
+            if not sets[i]:
                 break
-            self.makeSet(tokens, sets, i)
+            makeSet(tokens, sets, i)
+            sets[i].finish()
         else:
-            sets.append([])
-            self.makeSet(None, sets, len(tokens))
+            sets.append(_EarleySet())
+            self.links.append({})
+            self.leo_links.append({})
+            makeSet(None, sets, len(tokens))
 
-        finalitem = (self.finalState(tokens), 0)
+        finalitem = self.finalState(tokens)  # parent set 0
         if finalitem not in sets[-2]:
             if len(tokens) > 0:
                 i = min(i, 1)
@@ -519,17 +1780,376 @@ class GenericParser(object):
         if self.profile_info is not None:
             self.dump_profile_info()
 
-        return self.buildTree(self._START, finalitem, tokens, len(sets) - 2)
+        tree = self.buildTree(
+            self.sym2id[self._START], finalitem, tokens, len(sets) - 2, self.subtrees
+        )
+        if syms is not None:
+            self.freezeSets(sets)
+            cache.add(self.edges, syms, (sets, self.links, self.leo_links))
+        return tree, sets
+
+    def reparseSets(self, result, start, end, tokens):
+        """Do the work of reparse(): return the parse tree and the
+        Earley sets."""
+        old_tokens = result.tokens
+        tokens = list(old_tokens[:start]) + list(tokens) + list(old_tokens[end:])
+        return self.resumeSets(
+            tokens, result.chart, len(old_tokens), start, end, result.subtrees
+        )
+
+    def resumeSets(self, tokens, chart, old_length, start, end, old_subtrees=None):
+        """Parse _tokens_, taking the Earley sets before token _start_
+        from _chart_, those of a parse of _old_length_ tokens that
+        agree with _tokens_ except for old tokens start up to _end_.
+        Return the parse tree and the Earley sets.  See reparse();
+        _old_subtrees_ are the subtrees of the old parse tree."""
+        old_sets, old_links, old_leo_links = chart
+        delta = len(tokens) - old_length
+
+        self.tokens = tokens
+        self.prepareTables()
+        self.reduce_checked = set(
+            [self.sym2id[lhs] for lhs in self.check_reduce if lhs in self.sym2id]
+        )
+
+        # The sets before the edit stay as they are.  Set _start_ is
+        # made again from set start - 1, since which items scanned into
+        # it are kept depends on the first token of the edit.
+        sets = old_sets[:start] + [_EarleySet()]
+        self.links = old_links[:start] + [{}]
+        self.leo_links = old_leo_links[:start] + [{}]
+        self.scanSet(tokens, sets, start - 1)
+        self.reused_sets = start
+
+        makeSet = self.setMaker()
+        # A set past the edit leads to the same sets after it as in the
+        # old parse if its items that can still be advanced are the
+        # same, and none of them started within the edit.  Items whose
+        # state has no transitions have been completed already.
+        same_from = end + delta if not self.reduce_checked else len(tokens)
+        states = self.states
+
+        def advancing(set):
+            return [
+                item
+                for item in set
+                if states[item & _STATE_MASK].T or states[item & _STATE_MASK].N
+            ]
+
+        first = start << _STATE_BITS
+        shift = delta << _STATE_BITS
+        failed = len(tokens) - 1
+        same = None
+        for i in range(start, len(tokens)):
+            sets.append(_EarleySet())
+            self.links.append({})
+            self.leo_links.append({})
+
+            if not sets[i]:
+                failed = i - 1
+                break
+            makeSet(tokens, sets, i)
+            sets[i].finish()
+
+            if i >= same_from:
+                cur, old = advancing(sets[i]), advancing(old_sets[i - delta])
+                own = i << _STATE_BITS
+                if (
+                    len(cur) == len(old)
+                    and not [item for item in cur if first <= item < own]
+                    and set([item if item < first else item - shift for item in cur])
+                    == set(old)
+                ):
+                    sets[i + 1 :] = []
+                    del self.links[i + 1 :]
+                    del self.leo_links[i + 1 :]
+                    same = i - delta
+                    self.shiftSets(sets, old_sets, old_links, old_leo_links, same, delta)
+                    self.reused_sets += len(sets) - i - 1
+                    break
+        else:
+            sets.append(_EarleySet())
+            self.links.append({})
+            self.leo_links.append({})
+            makeSet(None, sets, len(tokens))
+
+        finalitem = self.finalState(tokens)
+        if finalitem not in sets[-2]:
+            if len(tokens) > 0:
+                self.error(tokens, failed)
+            else:
+                self.error(None, None)
+
+        # Subtrees of the old parse tree within the Earley sets taken
+        # over from it come out the same
+        subtrees = self.subtrees
+        if subtrees is not None and old_subtrees:
+            limit = same << _STATE_BITS if same is not None else None
+            for key, node in old_subtrees.items():
+                sym, item, k = key
+                if k < start:
+                    subtrees[key] = node
+                elif limit is not None and item >= limit:
+                    subtrees[(sym, item + shift, k + delta)] = node
+
+        tree = self.buildTree(
+            self.sym2id[self._START], finalitem, tokens, len(sets) - 2, subtrees
+        )
+        return tree, sets
+
+    def scanSet(self, tokens, sets, i):
+        """Add the items of Earley set _i_ that scan token _i_ to set
+        i + 1, as makeSet() does, but leave out the completions in set
+        i; reparse() uses this when set i is already complete."""
+        token = tokens[i]
+        ttype = self.typestring(token)
+        if ttype is not None:
+            fn, arg = self.gotoT, self.sym2id.get(ttype)
+        else:
+            fn, arg = self.gotoST, token
+        next, next_links = sets[i + 1], self.links[i + 1]
+        add, goto, viable = self.add, self.goto, self.viable
+        next_sym = self.lookaheadSym(tokens, i + 1)
+        nextitem = (i + 1) << _STATE_BITS
+        for item in sets[i]:
+            for k in fn(item & _STATE_MASK, arg):
+                if k is not None and viable(k, next_sym):
+                    add(next, (item & ~_STATE_MASK) | k, next_links, item)
+                    nk = goto(k, 0)
+                    if nk is not None and viable(nk, next_sym):
+                        add(next, nextitem | nk)
+
+    def shiftSets(self, sets, old_sets, old_links, old_leo_links, same, delta):
+        """Append the Earley sets of an earlier parse after set _same_
+        to _sets_, and their back-pointers to self.links and
+        self.leo_links, moving them _delta_ tokens along.  Items whose
+        parent set is _same_ or later move with them; the others are
+        started before the edit that reparse() is making."""
+        first = same + 1
+        if delta == 0:
+            sets += old_sets[first:]
+            self.links += old_links[first:]
+            self.leo_links += old_leo_links[first:]
+            return
+        limit = same << _STATE_BITS
+        shift = delta << _STATE_BITS
+        chains = {}
+
+        def move(item):
+            return item + shift if item >= limit else item
+
+        def moveChain(chain):
+            if chain is None:
+                return None
+            moved = chains.get(id(chain))
+            if moved is None:
+                top, pitem, state, rule, next = chain
+                moved = chains[id(chain)] = (
+                    move(top),
+                    move(pitem),
+                    state,
+                    rule,
+                    moveChain(next),
+                )
+            return moved
+
+        for old in old_sets[first:]:
+            new = _EarleySet([move(item) for item in old])
+            if old.members is None:
+                new.finish()
+            sets.append(new)
+        for old in old_links[first:]:
+            links = {}
+            for item, link in old.items():
+                # Back-pointers are (predecessor, cause, rule) triples,
+                # with -1 for none
+                link = list(link)
+                for j in range(0, len(link), 3):
+                    link[j] = move(link[j])
+                    link[j + 1] = move(link[j + 1])
+                links[move(item)] = tuple(link)
+            self.links.append(links)
+        for old in old_leo_links[first:]:
+            pending = {}
+            for top, entries in old.items():
+                pending[move(top)] = [
+                    (moveChain(chain), move(cause), rule)
+                    for chain, cause, rule in entries
+                ]
+            self.leo_links.append(pending)
+
+    def startSets(self, tokens):
+        """Set up for parsing _tokens_, bringing the tables up to
+        date, and return the list of Earley sets with the first one
+        in it."""
+        self.tokens = tokens
+        self.prepareTables()
+
+        sets = [self.initialSet()]
+        self.links = [{}]
+        self.leo_links = [{}]
+        self.reduce_checked = set(
+            [self.sym2id[lhs] for lhs in self.check_reduce if lhs in self.sym2id]
+        )
+        return sets
+
+    def initialSet(self):
+        """Return Earley set 0, before any token is scanned."""
+        # State 1 is the kernel state for START ::= |- . start.  It
+        # predicts nothing if start only derives the empty string.
+        items = [1]
+        nk = self.goto(1, 0)
+        if nk is not None:
+            items.append(nk)
+        return _EarleySet(items)
+
+    def setMaker(self):
+        """Return makeSet_memo() or makeSet_fast() if they can be
+        used, else makeSet()."""
+        if (
+            self.compiled
+            and self.profile_info is None
+            and not self.debug.get("rules")
+            and not self.debug.get("reduce")
+        ):
+            if self.memoize_sets and not self.reduce_checked:
+                return self.makeSet_memo
+            return self.makeSet_fast
+        return self.makeSet
+
+    def feed(self, token):
+        """Add _token_ to the input of a parse that is given its tokens
+        one at a time, rather than all at once to parse().  The first
+        call starts the parse; call finish() after the last token for
+        the parse tree.
+
+        The Earley sets are built up to _token_ as it arrives, so a
+        scanner and the parser can work in step, and error() is called
+        with the index of the first token that can't follow the ones
+        before it as soon as it has been fed.  The parse is then over.
+        The LALR(1) tables aren't used.
+
+        A parser can be fed one input at a time; give each input its
+        own session() to feed several at once.
+        """
+        if self.feeding is None:
+            self.feeding = (self.startSets([]), self.setMaker())
+        sets, makeSet = self.feeding
+        tokens = self.tokens
+        i = len(tokens)
+        tokens.append(token)
+        sets.append(_EarleySet())
+        self.links.append({})
+        self.leo_links.append({})
+        # tokens[i + 1] isn't known yet, so makeSet() doesn't filter
+        # set i + 1 by it; set i + 1 is empty only if _token_ can't
+        # be scanned.
+        makeSet(tokens, sets, i)
+        sets[i].finish()
+        if not sets[i + 1]:
+            self.feeding = None
+            try:
+                if self.debug.get("errorstack", False):
+                    self.errorstack(
+                        tokens, i, str(self.debug["errorstack"]) == "full"
+                    )
+                self.error(tokens, i)
+            finally:
+                if not self.keep_chart:
+                    self.tokens = self.links = self.leo_links = None
+
+    def finish(self):
+        """End the input of a parse given its tokens with feed(), and
+        return the parse tree.  error() is called if the input ended
+        too soon, with the index of the last token.  As with parse(),
+        the Earley sets are then dropped unless self.keep_chart is
+        set."""
+        if self.feeding is None:
+            self.feeding = (self.startSets([]), self.setMaker())
+        sets, makeSet = self.feeding
+        self.feeding = None
+        tokens = self.tokens
+        try:
+            sets.append(_EarleySet())
+            self.links.append({})
+            self.leo_links.append({})
+            makeSet(None, sets, len(tokens))
+
+            finalitem = self.finalState(tokens)
+            if finalitem not in sets[-2]:
+                if len(tokens) > 0:
+                    self.error(tokens, len(tokens) - 1)
+                else:
+                    self.error(None, None)
+
+            if self.profile_info is not None:
+                self.dump_profile_info()
+
+            return self.buildTree(
+                self.sym2id[self._START], finalitem, tokens, len(sets) - 2
+            )
+        finally:
+            if not self.keep_chart:
+                self.tokens = self.links = self.leo_links = None
+
+    async def parse_async(self, tokens, yield_every=500, yield_ms=None):
+        """Parse _tokens_, which can be an async iterator, in an
+        asyncio task, and return the parse tree.
+
+        Parsing a large input takes a while, and parse() would hold
+        up the event loop all that time.  This feeds the tokens to a
+        session() of this parser and gives other tasks a turn after
+        every _yield_every_ tokens, and, if _yield_ms_ is set, once
+        that many milliseconds have gone by since the last turn.  The
+        task can be cancelled at any of those points.  Many parses can
+        so go on at once.
+        """
+        # Loaded here so that programs that don't parse this way
+        # don't pay for it
+        import asyncio
+
+        session = self.session()
+        if not hasattr(tokens, "__aiter__"):
+            tokens = _aiter(tokens)
+        count = 0
+        if yield_ms is not None:
+            deadline = time.monotonic() + yield_ms / 1000.0
+        async for token in tokens:
+            session.feed(token)
+            count += 1
+            if count == yield_every or (
+                yield_ms is not None and time.monotonic() >= deadline
+            ):
+                await asyncio.sleep(0)
+                count = 0
+                if yield_ms is not None:
+                    deadline = time.monotonic() + yield_ms / 1000.0
+        return session.finish()
+
+    def prepareTables(self):
+        """Bring the tables up to date with the grammar, if it has
+        changed, for parse() or recognize()."""
+        if self.ruleschanged:
+            if self.cache_dir:
+                self.compile()
+            elif not (self.findTables() or self.updateTables()):
+                self.makeTables()
 
     def isnullable(self, sym):
         #  For symbols in G_e only.
         return sym.startswith(self._NULLABLE)
 
-    def skip(self, xxx_todo_changeme, pos=0):
-        _, rhs = xxx_todo_changeme
+    def istail(self, sym):
+        #  For symbols in G_e only; see splitRule().
+        if sym.startswith(self._NULLABLE):
+            sym = sym[len(self._NULLABLE) :]
+        return sym.startswith(self._TAIL)
+
+    def skip(self, rule, pos=0):
+        rhs = self.rule_rhs[rule]
         n = len(rhs)
         while pos < n:
-            if not self.isnullable(rhs[pos]):
+            if not self.sym_nullable[rhs[pos]]:
                 break
             pos = pos + 1
         return pos
@@ -541,61 +2161,55 @@ class GenericParser(object):
         #  Compute \epsilon-kernel state's core and see if
         #  it exists already.
         #
+        rule_rhs = self.rule_rhs
         kitems = []
         for rule, pos in self.states[state].items:
-            lhs, rhs = rule
-            if rhs[pos : pos + 1] == (sym,):
+            rhs = rule_rhs[rule]
+            if pos < len(rhs) and rhs[pos] == sym:
                 kitems.append((rule, self.skip(rule, pos + 1)))
 
         tcore = tuple(sorted(kitems))
         if tcore in self.cores:
             return self.cores[tcore]
         #
-        #  Nope, doesn't exist.  Compute it and the associated
-        #  \epsilon-nonkernel state together; we'll need it right away.
+        #  Nope, doesn't exist.  Compute it.
         #
         k = self.cores[tcore] = len(self.states)
-        K, NK = _State(k, kitems), _State(k + 1, [])
-        self.states[k] = K
-        predicted = {}
-
-        edges = self.edges
-        rules = self.newrules
-        for X in K, NK:
-            worklist = X.items
-            for item in worklist:
-                rule, pos = item
-                lhs, rhs = rule
-                if pos == len(rhs):
-                    X.complete.append(rule)
-                    continue
-
-                nextSym = rhs[pos]
-                key = (X.stateno, nextSym)
-                if nextSym not in rules:
-                    if key not in edges:
-                        edges[key] = None
-                        X.T.append(nextSym)
-                else:
-                    edges[key] = None
-                    if nextSym not in predicted:
-                        predicted[nextSym] = 1
-                        for prule in rules[nextSym]:
-                            ppos = self.skip(prule)
-                            new = (prule, ppos)
-                            NK.items.append(new)
-            #
-            #  Problem: we know K needs generating, but we
-            #  don't yet know about NK.  Can't commit anything
-            #  regarding NK to self.edges until we're sure.  Should
-            #  we delay committing on both K and NK to avoid this
-            #  hacky code?  This creates other problems..
-            #
-            if X is K:
-                edges = {}
+        assert k <= _STATE_MASK, "Too many parser states to pack into an item"
+        K = _State(k, kitems)
+        self.states.append(K)
+        self.addTransitions(K)
+        #
+        #  Compute the associated \epsilon-nonkernel state;
+        #  we'll need it right away.
+        #
+        nk = self.makeNonkernel(k)
+        if nk is not None:
+            self.edges[k << self.symbits] = nk
+        return k
 
-        if NK.items == []:
-            return k
+    def makeNonkernel(self, state):
+        """Return the number of the \\epsilon-nonkernel state of kernel
+        state number _state_, making it if needed: the items predicted
+        by the state's kernel.  Return None if it predicts nothing."""
+        lhs2rules, rule_rhs = self.lhs2rules, self.rule_rhs
+        nonterminal = self.sym_nonterminal
+        predicted = {}
+        items = []
+        for sym in self.states[state].N:
+            predicted[sym] = 1
+            for prule in lhs2rules[sym]:
+                items.append((prule, self.skip(prule)))
+        for rule, pos in items:
+            rhs = rule_rhs[rule]
+            if pos < len(rhs):
+                sym = rhs[pos]
+                if nonterminal[sym] and sym not in predicted:
+                    predicted[sym] = 1
+                    for prule in lhs2rules[sym]:
+                        items.append((prule, self.skip(prule)))
+        if not items:
+            return None
 
         #
         #  Check for \epsilon-nonkernel's core.  Unfortunately we
@@ -604,16 +2218,43 @@ class GenericParser(object):
         #
         tcore = tuple(sorted(predicted.keys()))
         if tcore in self.cores:
-            self.edges[(k, None)] = self.cores[tcore]
-            return k
+            return self.cores[tcore]
 
-        nk = self.cores[tcore] = self.edges[(k, None)] = NK.stateno
-        self.edges.update(edges)
-        self.states[nk] = NK
-        return k
+        nk = self.cores[tcore] = len(self.states)
+        assert nk <= _STATE_MASK, "Too many parser states to pack into an item"
+        NK = _State(nk, items)
+        self.states.append(NK)
+        self.addTransitions(NK)
+        return nk
+
+    def addTransitions(self, X):
+        """Fill in the completed rules and the (still unresolved)
+        transitions of new state _X_ from its items."""
+        rule_rhs = self.rule_rhs
+        edges = self.edges
+        shift = self.symbits
+        nonterminal = self.sym_nonterminal
+        for rule, pos in X.items:
+            rhs = rule_rhs[rule]
+            if pos == len(rhs):
+                X.complete.append(rule)
+                continue
+
+            nextSym = rhs[pos]
+            key = (X.stateno << shift) | nextSym
+            if key not in edges:
+                edges[key] = None
+                if nonterminal[nextSym]:
+                    X.N.append(nextSym)
+                else:
+                    X.T.append(nextSym)
 
     def goto(self, state, sym):
-        key = (state, sym)
+        """Return the state reached from _state_ on symbol number _sym_,
+        or None if there is no such transition.  Symbol number 0 is the
+        epsilon transition from a kernel state to its nonkernel state.
+        """
+        key = (state << self.symbits) | sym
         if key not in self.edges:
             #
             #  No transitions from state on sym.
@@ -625,37 +2266,120 @@ class GenericParser(object):
             #
             #  Target state isn't generated yet.  Remedy this.
             #
-            rv = self.makeState(state, sym)
+            if sym == 0:
+                rv = self.makeNonkernel(state)
+                if rv is None:
+                    del self.edges[key]
+                    return None
+            else:
+                rv = self.makeState(state, sym)
             self.edges[key] = rv
         return rv
 
     def gotoT(self, state, t):
         if self.debug["rules"]:
-            print("Terminal", t, state)
+            print("Terminal", self.sym_names[t] if t is not None else None, state)
+        if t is None:
+            # A token type that doesn't appear in the grammar
+            return []
         return [self.goto(state, t)]
 
     def gotoST(self, state, st):
         if self.debug["transition"]:
             print("GotoST", st, state)
         rv = []
+        symbols = self.sym_names
         for t in self.states[state].T:
-            if st == t:
+            if st == symbols[t]:
                 rv.append(self.goto(state, t))
         return rv
 
-    def add(self, set, item, i=None, predecessor=None, causal=None):
-        if predecessor is None:
-            if item not in set:
-                set.append(item)
+    def lookaheadSym(self, tokens, i):
+        """Return the symbol number of the type of token _i_, which
+        the items of Earley set _i_ must be able to start with; see
+        viable().  Return None if the items can't be filtered: after
+        the last token, for tokens whose type isn't known, or when
+        self.lookahead is off."""
+        if not self.lookahead or tokens is None or i >= len(tokens):
+            return None
+        return self.tokenSym(tokens[i])
+
+    def tokenSym(self, token):
+        """Return the symbol number of the type of _token_, or None if
+        its type isn't known or isn't in the grammar.
+
+        Without typestring(), gotoST() matches tokens to terminals by
+        ==, and a token may compare equal to more than one of them.
+        The type is then known only for strings, and for tokens whose
+        == is that of GenericToken, which compares just the kind."""
+        ttype = self.typestring(token)
+        if ttype is None:
+            if type(token) is str:
+                ttype = token
+            elif type(token).__eq__ is GenericToken.__eq__:
+                ttype = token.kind
+            else:
+                return None
+        return self.sym2id.get(ttype)
+
+    def firstSet(self, state):
+        """
+        Return the set of terminals that state number _state_ can scan
+        next, including those of the rules it predicts: that is, the
+        FIRST sets of whatever follows the dots of its items.  Return
+        None if the state has a complete rule, since that needs no
+        token.
+
+        The rules a kernel state predicts are the items of its
+        \\epsilon-nonkernel state, which makeNonkernel() already
+        computes, so there is nothing else to work out here.  The
+        result is cached in self.first_sets, the one cache that
+        sessions share rather than each having its own; threads racing
+        to fill in an entry store the same value.
+        """
+        X = self.states[state]
+        if X.complete:
+            first = None
         else:
-            key = (item, i)
-            if item not in set:
-                self.links[key] = []
-                set.append(item)
-            self.links[key].append((predecessor, causal))
+            first = set(X.T)
+            nk = self.goto(state, 0)
+            if nk is not None:
+                first.update(self.states[nk].T)
+        self.first_sets[state] = first
+        return first
+
+    def viable(self, state, sym):
+        """Return False if an item in state number _state_ can't go on
+        with a token of symbol number _sym_; if _sym_ is None, don't
+        filter.  Such an item is dead as soon as it is made, so it
+        needn't be added to its Earley set."""
+        if sym is None:
+            return True
+        first = self.first_sets.get(state, 0)
+        if first == 0:
+            first = self.firstSet(state)
+        return first is None or sym in first
+
+    def add(self, set, item, links=None, predecessor=-1, cause=-1, rule=-1):
+        """Add _item_ to Earley _set_ if it isn't there already.  If
+        _links_, the set's back-pointer table, is given also record
+        how the item was reached: from item _predecessor_ of an earlier
+        set, either by scanning a token (cause and rule are -1), or
+        because item _cause_ of this set completed rule number _rule_.
+        """
+        members = set.members
+        if item not in members:
+            members.add(item)
+            set.append(item)
+            if links is not None:
+                links[item] = (predecessor, cause, rule)
+        elif links is not None:
+            # The item may have been added by addLeo()
+            links[item] = links.get(item, ()) + (predecessor, cause, rule)
 
     def makeSet(self, tokens, sets, i):
         cur, next = sets[i], sets[i + 1]
+        cur_links, next_links = self.links[i], self.links[i + 1]
 
         if tokens is not None:
             token = tokens[i]
@@ -664,207 +2388,1113 @@ class GenericParser(object):
             ttype = None
             token = None
         if ttype is not None:
-            fn, arg = self.gotoT, ttype
+            fn, arg = self.gotoT, self.sym2id.get(ttype)
         else:
             fn, arg = self.gotoST, token
 
+        add, goto, states, rule_lhs = self.add, self.goto, self.states, self.rule_lhs
+        edges, shift = self.edges, self.symbits
+        viable = self.viable
+        cur_sym = self.lookaheadSym(tokens, i)
+        next_sym = self.lookaheadSym(tokens, i + 1)
+        nextitem = (i + 1) << _STATE_BITS
+        curitem = i << _STATE_BITS
+        # Leo items skip reductions, which debugging and profiling watch
+        leo = self.leo and self.profile_info is None and not self.debug.get("reduce")
         for item in cur:
-            ptr = (item, i)
-            state, parent = item
-            add = fn(state, arg)
-            for k in add:
-                if k is not None:
-                    self.add(next, (k, parent), i + 1, ptr)
-                    nk = self.goto(k, None)
-                    if nk is not None:
-                        self.add(next, (nk, i + 1))
+            state, parent = item & _STATE_MASK, item >> _STATE_BITS
+            for k in fn(state, arg):
+                if k is not None and viable(k, next_sym):
+                    add(next, (parent << _STATE_BITS) | k, next_links, item)
+                    nk = goto(k, 0)
+                    if nk is not None and viable(nk, next_sym):
+                        add(next, nextitem | nk)
 
             if parent == i:
                 continue
 
-            for rule in self.states[state].complete:
-                lhs, rhs = rule
+            for rule in states[state].complete:
+                lhs = rule_lhs[rule]
                 if self.debug["reduce"]:
-                    self.debug_reduce(rule, tokens, parent, i)
+                    self.debug_reduce(self.id2rule[rule], tokens, parent, i)
                 if self.profile_info is not None:
-                    self.profile_rule(rule)
-                if lhs in self.check_reduce:
-                    if self.check_reduce[lhs] == "AST" and (
-                        tokens or hasattr(self, "tokens")
-                    ):
-                        if hasattr(self, "tokens"):
-                            tokens = self.tokens
-                        ast = self.reduce_ast(rule, self.tokens, item, i, sets)
-                    else:
-                        ast = None
-                    invalid = self.reduce_is_invalid(rule, ast, self.tokens, parent, i)
-                    if ast:
-                        del ast
-                    if invalid:
-                        if self.debug["reduce"]:
-                            print("Reduce %s invalid by check" % lhs)
+                    self.profile_rule(self.id2rule[rule])
+                if self.check_reduce and self.sym_names[lhs] in self.check_reduce:
+                    if self.checkReduce(rule, item, parent, i, sets):
                         continue
-                    pass
-                    pass
-                for pitem in sets[parent]:
-                    pstate, pparent = pitem
-                    k = self.goto(pstate, lhs)
-                    if k is not None:
-                        why = (item, i, rule)
-                        pptr = (pitem, parent)
-                        self.add(cur, (k, pparent), i, pptr, why)
-                        nk = self.goto(k, None)
-                        if nk is not None:
-                            self.add(cur, (nk, i))
-
-    def makeSet_fast(self, token, sets, i):
+                if leo:
+                    chain = self.leoItem(sets, parent, lhs)
+                    if chain is not None and chain[4] is not None:
+                        self.addLeo(cur, chain, item, rule, i)
+                        continue
+                waiting = sets[parent].waiting
+                if lhs in waiting:
+                    pitems = waiting[lhs]
+                else:
+                    pitems = waiting[lhs] = [
+                        pitem
+                        for pitem in sets[parent]
+                        if (((pitem & _STATE_MASK) << shift) | lhs) in edges
+                    ]
+                for pitem in pitems:
+                    k = goto(pitem & _STATE_MASK, lhs)
+                    if k is not None and viable(k, cur_sym):
+                        add(
+                            cur,
+                            (pitem & ~_STATE_MASK) | k,
+                            cur_links,
+                            pitem,
+                            item,
+                            rule,
+                        )
+                        nk = goto(k, 0)
+                        if nk is not None and viable(nk, cur_sym):
+                            add(cur, curitem | nk)
+
+    def recognize(self, tokens):
+        """
+        Return True if _tokens_ are a sentence of the grammar, or else
+        the index of the token parsing can't go on with; len(tokens)
+        if the input ends too soon.  Test the result with "is True".
+
+        This is parse() without the parse tree: back-pointers aren't
+        recorded and no rule actions are run, so it is faster and
+        takes far less memory.  Use it, say, to find out which of
+        several grammars applies.  Reductions are still checked with
+        reduce_is_invalid(); if a check needs the AST, back-pointers
+        are kept so that it can be built, and dropped afterwards
+        unless self.keep_chart is set.  error() isn't called.
+        """
+        try:
+            return self.recognizeSets(tokens)
+        finally:
+            if not self.keep_chart:
+                self.tokens = self.links = self.leo_links = None
+
+    def recognizeSets(self, tokens):
+        """Do the work of recognize()."""
+        self.tokens = tokens
+        self.prepareTables()
+        self.reduce_checked = set(
+            [self.sym2id[lhs] for lhs in self.check_reduce if lhs in self.sym2id]
+        )
+        links = "AST" in self.check_reduce.values()
+        if links:
+            makeSet = self.makeSet
+            self.links, self.leo_links = [{}], [{}]
+        else:
+            makeSet = self.recognizeSet
+
+        sets = [self.initialSet()]
+        for i in range(len(tokens) + 1):
+            sets.append(_EarleySet())
+            if links:
+                self.links.append({})
+                self.leo_links.append({})
+            if i < len(tokens):
+                makeSet(tokens, sets, i)
+                if not sets[i + 1]:
+                    # Lookahead filtering leaves out the items that
+                    # scan token i when token i + 1 can't follow it
+                    ttype = self.typestring(tokens[i])
+                    for item in sets[i]:
+                        if ttype is not None:
+                            scanned = self.gotoT(item & _STATE_MASK, self.sym2id.get(ttype))
+                        else:
+                            scanned = self.gotoST(item & _STATE_MASK, tokens[i])
+                        if [k for k in scanned if k is not None]:
+                            return i + 1
+                    return i
+                sets[i].finish()
+            else:
+                makeSet(None, sets, i)
+        if self.finalState(tokens) in sets[-2]:
+            return True
+        return len(tokens)
+
+    def recognizeSet(self, tokens, sets, i):
+        """makeSet() for recognize(): no back-pointers are recorded,
+        and Leo chains are just their top items.  Transitions are
+        looked up in self.edges directly, as in makeSet_fast(), and
+        only made with goto() if they haven't been built yet."""
+        token = tokens[i] if tokens is not None else None
+        cur, next = sets[i], sets[i + 1]
+        cur_members, next_members = cur.members, next.members
+        goto, states, rule_lhs = self.goto, self.states, self.rule_lhs
+        edges, shift = self.edges, self.symbits
+        first_sets, firstSet = self.first_sets, self.firstSet
+        checked = self.reduce_checked
+        nextitem = (i + 1) << _STATE_BITS
+        curitem = i << _STATE_BITS
+        ttype = token is not None and self.typestring(token) or None
+        tsym = self.sym2id.get(ttype)
+        cur_sym = self.lookaheadSym(tokens, i)
+        next_sym = self.lookaheadSym(tokens, i + 1)
+
+        for item in cur:
+            state, parent = item & _STATE_MASK, item >> _STATE_BITS
+            if token is None:
+                targets = ()
+            elif ttype is None:
+                targets = self.gotoST(state, token)
+            elif tsym is not None and ((state << shift) | tsym) in edges:
+                k = edges[(state << shift) | tsym]
+                targets = (k if k is not None else goto(state, tsym),)
+            else:
+                targets = ()
+            for k in targets:
+                if next_sym is not None:
+                    first = first_sets[k] if k in first_sets else firstSet(k)
+                    if first is not None and next_sym not in first:
+                        continue
+                new = (parent << _STATE_BITS) | k
+                if new not in next_members:
+                    next_members.add(new)
+                    next.append(new)
+                if (k << shift) in edges:
+                    nk = edges[k << shift]
+                    if nk is None:
+                        nk = goto(k, 0)
+                        if nk is None:
+                            continue
+                    if next_sym is not None:
+                        first = first_sets[nk] if nk in first_sets else firstSet(nk)
+                        if first is not None and next_sym not in first:
+                            continue
+                    new = nextitem | nk
+                    if new not in next_members:
+                        next_members.add(new)
+                        next.append(new)
+
+            if parent == i:
+                continue
+
+            for rule in states[state].complete:
+                lhs = rule_lhs[rule]
+                if lhs in checked and self.checkReduce(rule, item, parent, i, sets):
+                    continue
+                chain = self.leoItem(sets, parent, lhs)
+                if chain is not None and chain[4] is not None:
+                    new = chain[0]
+                    if new not in cur_members:
+                        cur_members.add(new)
+                        cur.append(new)
+                    continue
+                # leoItem() has filled in the completion index
+                for pitem in sets[parent].waiting[lhs]:
+                    k = edges[((pitem & _STATE_MASK) << shift) | lhs]
+                    if k is None:
+                        k = goto(pitem & _STATE_MASK, lhs)
+                    if cur_sym is not None:
+                        first = first_sets[k] if k in first_sets else firstSet(k)
+                        if first is not None and cur_sym not in first:
+                            continue
+                    new = (pitem & ~_STATE_MASK) | k
+                    if new not in cur_members:
+                        cur_members.add(new)
+                        cur.append(new)
+                    if (k << shift) in edges:
+                        nk = edges[k << shift]
+                        if nk is None:
+                            nk = goto(k, 0)
+                            if nk is None:
+                                continue
+                        if cur_sym is not None:
+                            first = first_sets[nk] if nk in first_sets else firstSet(nk)
+                            if first is not None and cur_sym not in first:
+                                continue
+                        new = curitem | nk
+                        if new not in cur_members:
+                            cur_members.add(new)
+                            cur.append(new)
+
+    def checkReduce(self, rule, item, parent, i, sets):
+        """Return True if self.reduce_is_invalid() rejects completing
+        rule number _rule_ by _item_ of Earley set _i_.  Only called
+        for rules whose lhs is in self.check_reduce."""
+        named_rule = self.id2rule[rule]
+        lhs = named_rule[0]
+        if self.check_reduce[lhs] == "AST":
+            ast = self.reduce_ast(named_rule, self.tokens, item, i, sets)
+        else:
+            ast = None
+        invalid = self.reduce_is_invalid(named_rule, ast, self.tokens, parent, i)
+        if invalid and self.debug["reduce"]:
+            print("Reduce %s invalid by check" % lhs)
+        return invalid
+
+    def makeSet_fast(self, tokens, sets, i):
         #
         #  Call *only* when the entire state machine has been built!
         #  It relies on self.edges being filled in completely, and
         #  then duplicates and inlines code to boost speed at the
         #  cost of extreme ugliness.
         #
+        token = tokens[i] if tokens is not None else None
         cur, next = sets[i], sets[i + 1]
+        cur_members, next_members = cur.members, next.members
+        cur_links, next_links = self.links[i], self.links[i + 1]
+        edges, shift = self.edges, self.symbits
+        checked = self.reduce_checked
+        use_leo = self.leo
+        nextitem = (i + 1) << _STATE_BITS
+        curitem = i << _STATE_BITS
         ttype = token is not None and self.typestring(token) or None
+        tsym = self.sym2id.get(ttype)
+        # Items that can't start with the token after theirs are dropped
+        first_sets, firstSet = self.first_sets, self.firstSet
+        cur_sym = self.lookaheadSym(tokens, i)
+        next_sym = self.lookaheadSym(tokens, i + 1)
 
         for item in cur:
-            ptr = (item, i)
-            state, parent = item
+            state, parent = item & _STATE_MASK, item >> _STATE_BITS
             if ttype is not None:
-                k = self.edges.get((state, ttype), None)
+                k = tsym and edges.get((state << shift) | tsym, None)
+                if k is not None and next_sym is not None:
+                    # if not self.viable(k, next_sym): k = None
+                    # INLINED --------v
+                    first = first_sets[k] if k in first_sets else firstSet(k)
+                    if first is not None and next_sym not in first:
+                        k = None
+                    # INLINED --------^
                 if k is not None:
-                    # self.add(next, (k, parent), i+1, ptr)
+                    # self.add(next, (parent << _STATE_BITS) | k, next_links, item)
                     # INLINED --------v
-                    new = (k, parent)
-                    key = (new, i + 1)
-                    if new not in next:
-                        self.links[key] = []
+                    new = (parent << _STATE_BITS) | k
+                    if new not in next_members:
+                        next_members.add(new)
                         next.append(new)
-                    self.links[key].append((ptr, None))
+                        next_links[new] = (item, -1, -1)
+                    else:
+                        next_links[new] += (item, -1, -1)
                     # INLINED --------^
-                    # nk = self.goto(k, None)
-                    nk = self.edges.get((k, None), None)
-                    if nk is not None:
-                        # self.add(next, (nk, i+1))
+                    # nk = self.goto(k, 0)
+                    nk = edges.get(k << shift, None)
+                    if nk is not None and self.viable(nk, next_sym):
+                        # self.add(next, nextitem | nk)
                         # INLINED -------------v
-                        new = (nk, i + 1)
-                        if new not in next:
+                        new = nextitem | nk
+                        if new not in next_members:
+                            next_members.add(new)
                             next.append(new)
                         # INLINED ---------------^
             else:
                 add = self.gotoST(state, token)
                 for k in add:
-                    if k is not None:
-                        self.add(next, (k, parent), i + 1, ptr)
-                        # nk = self.goto(k, None)
-                        nk = self.edges.get((k, None), None)
-                        if nk is not None:
-                            self.add(next, (nk, i + 1))
+                    if k is not None and self.viable(k, next_sym):
+                        self.add(next, (parent << _STATE_BITS) | k, next_links, item)
+                        # nk = self.goto(k, 0)
+                        nk = edges.get(k << shift, None)
+                        if nk is not None and self.viable(nk, next_sym):
+                            self.add(next, nextitem | nk)
 
             if parent == i:
                 continue
 
-            for rule in self.states[state].complete:
-                lhs, rhs = rule
-                for pitem in sets[parent]:
-                    pstate, pparent = pitem
-                    # k = self.goto(pstate, lhs)
-                    k = self.edges.get((pstate, lhs), None)
+            complete = self.states[state].complete
+            if not complete:
+                continue
+            waiting, leo = sets[parent].waiting, sets[parent].leo
+
+            for rule in complete:
+                lhs = self.rule_lhs[rule]
+                if lhs in checked and self.checkReduce(rule, item, parent, i, sets):
+                    continue
+                if not use_leo:
+                    chain = None
+                elif lhs in leo:
+                    chain = leo[lhs]
+                else:
+                    chain = self.leoItem(sets, parent, lhs)
+                if chain is not None and chain[4] is not None:
+                    self.addLeo(cur, chain, item, rule, i)
+                    continue
+                if lhs in waiting:
+                    pitems = waiting[lhs]
+                else:
+                    pitems = waiting[lhs] = [
+                        pitem
+                        for pitem in sets[parent]
+                        if (((pitem & _STATE_MASK) << shift) | lhs) in edges
+                    ]
+                for pitem in pitems:
+                    # k = self.goto(pitem & _STATE_MASK, lhs)
+                    k = edges.get(((pitem & _STATE_MASK) << shift) | lhs, None)
+                    if k is not None and cur_sym is not None:
+                        # if not self.viable(k, cur_sym): continue
+                        # INLINED ---------v
+                        first = first_sets[k] if k in first_sets else firstSet(k)
+                        if first is not None and cur_sym not in first:
+                            continue
+                        # INLINED ----------^
                     if k is not None:
-                        why = (item, i, rule)
-                        pptr = (pitem, parent)
-                        # self.add(cur, (k, pparent), i, pptr, why)
+                        # self.add(cur, (pitem & ~_STATE_MASK) | k, cur_links,
+                        #          pitem, item, rule)
                         # INLINED ---------v
-                        new = (k, pparent)
-                        key = (new, i)
-                        if new not in cur:
-                            self.links[key] = []
+                        new = (pitem & ~_STATE_MASK) | k
+                        if new not in cur_members:
+                            cur_members.add(new)
                             cur.append(new)
-                        self.links[key].append((pptr, why))
+                            cur_links[new] = (pitem, item, rule)
+                        else:
+                            # The item may have been added by addLeo()
+                            links = cur_links.get(new, ())
+                            cur_links[new] = links + (pitem, item, rule)
                         # INLINED ----------^
-                        # nk = self.goto(k, None)
-                        nk = self.edges.get((k, None), None)
-                        if nk is not None:
-                            # self.add(cur, (nk, i))
+                        # nk = self.goto(k, 0)
+                        nk = edges.get(k << shift, None)
+                        if nk is not None and self.viable(nk, cur_sym):
+                            # self.add(cur, curitem | nk)
                             # INLINED ---------v
-                            new = (nk, i)
-                            if new not in cur:
+                            new = curitem | nk
+                            if new not in cur_members:
+                                cur_members.add(new)
                                 cur.append(new)
                             # INLINED ----------^
 
-    def predecessor(self, key, causal):
-        for p, c in self.links[key]:
-            if c == causal:
-                return p
+    def makeSet_memo(self, tokens, sets, i):
+        """
+        makeSet_fast(), but replaying what it did for an Earley set
+        that came up before in the same configuration.
+
+        Sets at different positions often hold the same items but for
+        the positions of their parent sets: the set at the start of
+        each statement of a long statement list, say.  What makeSet()
+        does with such a set depends only on its items, the items of
+        the parent sets they complete into, those of their parent
+        sets in turn, and so on, and on the token types at _i_ and
+        i + 1.  Completed items can't be completed into, so once a set
+        is done, set.shape notes just the states of its items that can
+        still be advanced, with their parent sets numbered in the order
+        they come up.
+
+        The configuration of set _i_ is its items so far, with parent
+        sets numbered the same way, and the shapes of the sets they
+        reach.  Items are added to set i, and to i + 1, and get their
+        back-pointers, the same way for the same configuration and
+        token types.  The second time a configuration comes up,
+        self.set_memo records what was done, in terms of the numbered
+        sets, and replaySet() replays it after that.
+        """
+        shift = _STATE_BITS
+        mask = _STATE_MASK
+        cur = sets[i]
+        cur_sym = self.lookaheadSym(tokens, i)
+        if tokens is None:
+            tsym = -1
+        else:
+            ttype = self.typestring(tokens[i])
+            if ttype is not None:
+                tsym = self.sym2id.get(ttype)
+            elif cur_sym is not None:
+                # gotoST() scans the terminals the token is equal to,
+                # and viable() already takes that to be just the one
+                # of its type
+                tsym = cur_sym
+            else:
+                return self.makeSet_fast(tokens, sets, i)
+
+        # Number the sets reachable from set i, after -1 for no item
+        # and 0 for rule numbers, which aren't items
+        index = {-1: 0, i + 1: 2, i: 3}
+        nodes = [-1, 0, i + 1, i]
+        config = [len(cur)]
+        n = 4
+        for item in cur:
+            parent = item >> shift
+            if parent not in index:
+                index[parent] = n
+                nodes.append(parent)
+                n += 1
+            config.append((index[parent] << shift) | (item & mask))
+        j, limit = 4, self._SET_MEMO_REACH + 4
+        while j < n and j < limit:
+            shape = sets[nodes[j]].shape
+            if shape is None:
+                break
+            config.append(shape[0])
+            for parent in shape[1]:
+                if parent not in index:
+                    index[parent] = n
+                    nodes.append(parent)
+                    n += 1
+                config.append(index[parent])
+            j += 1
+
+        memo, key = self.set_memo, None
+        if j == n:
+            key = (tuple(config), tsym, cur_sym, self.lookaheadSym(tokens, i + 1))
+            # Configurations are recorded the second time they come up,
+            # so that those that don't come up again cost less
+            made = memo.get(key, False)
+            if made is False:
+                if len(memo) >= self._SET_MEMO_SIZE:
+                    memo.clear()
+                memo.setdefault(key, None)
+                key = None
+            elif made is not None and self.replaySet(sets, i, nodes, made):
+                self.replayed_sets += 1
+                return
+
+        start = len(cur)
+        cur_links = self.links[i]
+        if key is not None:
+            counts = dict([(item, len(link)) for item, link in cur_links.items()])
+        self.makeSet_fast(tokens, sets, i)
+
+        states, local, slots = self.states, [], []
+        parents = {i: 0}
+        for item in cur:
+            state = item & mask
+            if states[state].T or states[state].N:
+                parent = item >> shift
+                if parent not in parents:
+                    parents[parent] = len(parents)
+                    slots.append(parent)
+                local.append((parents[parent] << shift) | state)
+        local = tuple(local)
+        shape_ids = self.set_shapes
+        shape_id = shape_ids.get(local)
+        if shape_id is None:
+            if len(shape_ids) >= self._SET_MEMO_SIZE:
+                shape_ids.clear()
+            shape_id = shape_ids.setdefault(local, next(_shape_ids))
+        cur.shape = (shape_id, tuple(slots))
+        if key is None:
+            return
+
+        rule_base = 1 << shift
+
+        def number(item):
+            return (index[item >> shift] << shift) | (item & mask)
+
+        def numbers(link):
+            # (predecessor, cause, rule) triples
+            numbered = []
+            for j in range(0, len(link), 3):
+                rule = link[j + 2]
+                numbered += [
+                    number(link[j]),
+                    number(link[j + 1]),
+                    rule_base | rule if rule >= 0 else number(rule),
+                ]
+            return tuple(numbered)
+
+        try:
+            added = [number(item) for item in cur[start:]]
+            links = []
+            for item, link in cur_links.items():
+                link = link[counts.get(item, 0) :]
+                if link:
+                    links.append((number(item), numbers(link)))
+            leo = [
+                (number(cause), rule)
+                for entries in self.leo_links[i].values()
+                for chain, cause, rule in entries
+            ]
+            next_items = [number(item) for item in sets[i + 1]]
+            next_links = [
+                (number(item), numbers(link))
+                for item, link in self.links[i + 1].items()
+            ]
+            slots = tuple([index[parent] for parent in slots])
+        except KeyError:
+            # A parent set that isn't reachable from set i's items
+            return
+        memo[key] = (added, links, leo, next_items, next_links, shape_id, slots)
+
+    def replaySet(self, sets, i, nodes, made):
+        """Add to Earley sets _i_ and i + 1 the items and back-pointers
+        that makeSet_memo() recorded in _made_, for a set that reaches
+        sets _nodes_.  Return False, having changed nothing, if a Leo
+        chain comes out differently."""
+        added, links, leo, next_items, next_links, shape_id, slots = made
+        shift, mask = _STATE_BITS, _STATE_MASK
+        # -1 | state is -1, and 0 | rule is rule
+        bases = [-1, 0] + [node << shift for node in nodes[2:]]
+
+        # The Leo chains are those of the parent sets here
+        chains = []
+        for cause, rule in leo:
+            cause = bases[cause >> shift] | (cause & mask)
+            parent, lhs = cause >> shift, self.rule_lhs[rule]
+            chain = self.leoItem(sets, parent, lhs)
+            if chain is None or chain[4] is None:
+                return False
+            chains.append((chain, cause, rule))
+
+        cur, next = sets[i], sets[i + 1]
+        items = [bases[x >> shift] | (x & mask) for x in added]
+        cur.extend(items)
+        cur.members.update(items)
+        cur_links = self.links[i]
+        for x, link in links:
+            x = bases[x >> shift] | (x & mask)
+            link = tuple([bases[y >> shift] | (y & mask) for y in link])
+            if x in cur_links:
+                cur_links[x] += link
+            else:
+                cur_links[x] = link
+        pending = self.leo_links[i]
+        for entry in chains:
+            top = entry[0][0]
+            if top in pending:
+                pending[top].append(entry)
+            else:
+                pending[top] = [entry]
+        cur.shape = (shape_id, tuple([nodes[slot] for slot in slots]))
+
+        items = [bases[x >> shift] | (x & mask) for x in next_items]
+        next.extend(items)
+        next.members.update(items)
+        pointers = self.links[i + 1]
+        for x, link in next_links:
+            pointers[bases[x >> shift] | (x & mask)] = tuple(
+                [bases[y >> shift] | (y & mask) for y in link]
+            )
+        return True
+
+    def leoItem(self, sets, p, lhs):
+        """
+        Leo's optimization for right recursion, as per J. M. I. M. Leo,
+        "A general context-free parsing algorithm running in linear time
+        on every LR(k) grammar without using lookahead", Theoretical
+        Computer Science 82(1), pp. 165-176, 1991.
+
+        Completing nonterminal number _lhs_ in Earley set _p_ is
+        deterministic when just one item of set p can advance over
+        _lhs_, and what it advances to is a state with a single
+        complete rule and nothing else.  That item then completes in
+        turn, in its own parent set, and so on.  Right recursion makes
+        such chains as long as the input, and following them at each
+        Earley set takes quadratic time.
+
+        Return the chain for _lhs_ in set _p_, or None if completing
+        _lhs_ there isn't deterministic.  A chain is a tuple (top, pitem,
+        state, rule, next): the item that _pitem_ of set p advances to
+        is in _state_ and completes rule number _rule_; _next_ is the
+        chain that completion starts, or None, and _top_ is the item
+        at the end of the chain.  Chains are computed once per set and
+        nonterminal, so makeSet() can add the top item right away;
+        see addLeo().
+
+        Either way, the completion index of set p is filled in for
+        _lhs_.  Chains are only used if self.leo is set.
+        """
+        if self.leo:
+            return self.leoChain(sets, p, lhs)
+        waiting = sets[p].waiting
+        if lhs not in waiting:
+            edges, shift = self.edges, self.symbits
+            waiting[lhs] = [
+                pitem
+                for pitem in sets[p]
+                if (((pitem & _STATE_MASK) << shift) | lhs) in edges
+            ]
+        return None
+
+    def leoChain(self, sets, p, lhs):
+        """Return the Leo chain for _lhs_ in Earley set _p_, or None,
+        as leoItem() does, whether or not self.leo is set."""
+        leo = sets[p].leo
+        if lhs in leo:
+            return leo[lhs]
+        # Guard against cycles of unit rules
+        leo[lhs] = None
+
+        waiting = sets[p].waiting
+        if lhs in waiting:
+            pitems = waiting[lhs]
+        else:
+            edges, shift = self.edges, self.symbits
+            pitems = waiting[lhs] = [
+                pitem
+                for pitem in sets[p]
+                if (((pitem & _STATE_MASK) << shift) | lhs) in edges
+            ]
+        if len(pitems) != 1:
+            return None
+        pitem = pitems[0]
+        k = self.goto(pitem & _STATE_MASK, lhs)
+        state = self.states[k]
+        if state.T or state.N or len(state.complete) != 1:
+            return None
+        rule = state.complete[0]
+        if self.rule_lhs[rule] in self.reduce_checked:
+            return None
+
+        item = (pitem & ~_STATE_MASK) | k
+        next = self.leoChain(sets, pitem >> _STATE_BITS, self.rule_lhs[rule])
+        top = next[0] if next is not None else item
+        chain = leo[lhs] = (top, pitem, k, rule, next)
+        return chain
+
+    def freezeSets(self, sets):
+        """
+        Fill in the completion index and the Leo chains of each of the
+        finished Earley _sets_ for every nonterminal its items can
+        advance over, as makeSet() would the first time it needs them.
+        Sets in self.prefix_cache are completed into by parses in
+        other threads and of other parsers; once frozen, those only
+        read them.
+        """
+        states, leoChain = self.states, self.leoChain
+        for p in range(len(sets)):
+            leo = sets[p].leo
+            for item in sets[p]:
+                for lhs in states[item & _STATE_MASK].N:
+                    if lhs not in leo:
+                        leoChain(sets, p, lhs)
+
+    def addLeo(self, set, chain, cause, rule, i):
+        """Add the top item of Leo _chain_ to Earley _set_ number _i_,
+        where it was started by item _cause_ completing rule number
+        _rule_.  The items in between aren't added; their back-pointers
+        are filled in by expandLeo() if the parse tree needs them."""
+        top = chain[0]
+        members = set.members
+        if top not in members:
+            members.add(top)
+            set.append(top)
+        pending = self.leo_links[i]
+        if top in pending:
+            pending[top].append((chain, cause, rule))
+        else:
+            pending[top] = [(chain, cause, rule)]
+
+    def expandLeo(self, k, item):
+        """Fill in the back-pointers of _item_ of Earley set _k_, and of
+        the items leading to it, that addLeo() left out."""
+        links = self.links[k]
+        for chain, cause, rule in self.leo_links[k].pop(item):
+            while chain is not None:
+                top, pitem, state, nextrule, chain = chain
+                x = (pitem & ~_STATE_MASK) | state
+                link = (pitem, cause, rule)
+                if x not in links:
+                    links[x] = link
+                else:
+                    old = links[x]
+                    if link in [old[j : j + 3] for j in range(0, len(old), 3)]:
+                        # The rest of the chain is already there
+                        break
+                    links[x] = old + link
+                cause, rule = x, nextrule
+
+    def makeLRTables(self):
+        """
+        Build LALR(1) parse tables for recognizeLR() from the same
+        epsilon-free grammar and rule numbers the Earley parser uses.
+        \\e_ symbols are skipped over, as skip() does for the Earley
+        states, and filled in by deriveEpsilon() when the tree is
+        built; the \\e_ rules aren't part of the tables.
+
+        Set self.lr_tables to (action, goto, lengths): the first two
+        dicts are keyed by (state << self.symbits) | sym, sym 0 being
+        the end of the input.  An action is the state to shift to, or
+        -1 - rule to reduce by rule number rule; None marks a conflict.
+        lengths[rule] is the number of symbols of rule number rule on
+        the stack.  State 0 is the one after START ::= |- .
+
+        Lookaheads are worked out as in Aho, Sethi and Ullman,
+        "Compilers: Principles, Techniques, and Tools", section 4.7:
+        from each kernel item, those that arise in its closure are
+        spontaneous, and those that only come from the item itself
+        (PROPAGATE below) are propagated, until nothing changes.
+        """
+        rule_rhs, lhs2rules = self.rule_rhs, self.lhs2rules
+        nonterminal, skip = self.sym_nonterminal, self.skip
+        PROPAGATE = -1
+
+        #  The \e_ forms aside, nonterminals in the epsilon-free
+        #  grammar aren't nullable, so FIRST of a nonterminal is the
+        #  FIRST of the first symbol of its rules.
+        first = [set() for sym in self.sym_names]
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rules in enumerate(lhs2rules):
+                if self.sym_nullable[lhs]:
+                    continue
+                for rule in rules:
+                    pos = skip(rule)
+                    if pos == len(rule_rhs[rule]):
+                        continue
+                    sym = rule_rhs[rule][pos]
+                    if nonterminal[sym]:
+                        new = first[sym] - first[lhs]
+                        if new:
+                            first[lhs].update(new)
+                            changed = True
+                    elif sym not in first[lhs]:
+                        first[lhs].add(sym)
+                        changed = True
+
+        def follow(rule, pos):
+            """FIRST of what follows position _pos_ in _rule_, and
+            whether there's nothing there but \\e_ symbols"""
+            pos = skip(rule, pos)
+            rhs = rule_rhs[rule]
+            if pos == len(rhs):
+                return (), True
+            if nonterminal[rhs[pos]]:
+                return first[rhs[pos]], False
+            return (rhs[pos],), False
+
+        #
+        #  The LR(0) states, by their kernel items (rule, pos).
+        #
+        start = self.sym2id[self._START]
+        kernels = [tuple(sorted([(rule, skip(rule, 1)) for rule in lhs2rules[start]]))]
+        kernel2state = {kernels[0]: 0}
+        trans = []
+        for kernel in kernels:
+            items = list(kernel)
+            predicted = set()
+            moves = {}
+            for rule, pos in items:
+                rhs = rule_rhs[rule]
+                if pos == len(rhs):
+                    continue
+                sym = rhs[pos]
+                if sym in moves:
+                    moves[sym].append((rule, skip(rule, pos + 1)))
+                else:
+                    moves[sym] = [(rule, skip(rule, pos + 1))]
+                if nonterminal[sym] and sym not in predicted:
+                    predicted.add(sym)
+                    items.extend([(r, skip(r)) for r in lhs2rules[sym]])
+            edges = {}
+            for sym, moved in moves.items():
+                moved = tuple(sorted(set(moved)))
+                if moved not in kernel2state:
+                    kernel2state[moved] = len(kernels)
+                    kernels.append(moved)
+                edges[sym] = kernel2state[moved]
+            trans.append(edges)
+
+        #
+        #  Lookaheads of the kernel items, and of complete nonkernel
+        #  items, which are only kept to reduce by.
+        #
+        lookaheads = {}
+        propagate = {}
+        for item in kernels[0]:
+            lookaheads[(0, item)] = set([0])
+
+        def add(key, la, source):
+            if key in lookaheads:
+                lookaheads[key].update(la)
+            else:
+                lookaheads[key] = set(la)
+            if PROPAGATE in la:
+                lookaheads[key].discard(PROPAGATE)
+                if source in propagate:
+                    propagate[source].append(key)
+                else:
+                    propagate[source] = [key]
+
+        for state, kernel in enumerate(kernels):
+            edges = trans[state]
+            for item in kernel:
+                rule, pos = item
+                rhs = rule_rhs[rule]
+                lookaheads.setdefault((state, item), set())
+                if pos == len(rhs):
+                    continue
+                source = (state, item)
+                sym = rhs[pos]
+                add((edges[sym], (rule, skip(rule, pos + 1))), (PROPAGATE,), source)
+                if not nonterminal[sym]:
+                    continue
+                la, empty = follow(rule, pos + 1)
+                predicted = {sym: set(la)}
+                if empty:
+                    predicted[sym].add(PROPAGATE)
+                worklist = [sym]
+                while worklist:
+                    lhs = worklist.pop()
+                    for r in lhs2rules[lhs]:
+                        p = skip(r)
+                        if p == len(rule_rhs[r]):
+                            continue
+                        sym = rule_rhs[r][p]
+                        if not nonterminal[sym]:
+                            continue
+                        la, empty = follow(r, p + 1)
+                        la = set(la)
+                        if empty:
+                            la.update(predicted[lhs])
+                        if sym not in predicted:
+                            predicted[sym] = la
+                        elif la <= predicted[sym]:
+                            continue
+                        else:
+                            predicted[sym].update(la)
+                        worklist.append(sym)
+                for lhs, la in predicted.items():
+                    for r in lhs2rules[lhs]:
+                        p = skip(r)
+                        if p == len(rule_rhs[r]):
+                            add((state, (r, p)), la, source)
+                        else:
+                            sym = rule_rhs[r][p]
+                            add((edges[sym], (r, skip(r, p + 1))), la, source)
+
+        worklist = list(propagate.keys())
+        while worklist:
+            source = worklist.pop()
+            la = lookaheads[source]
+            for key in propagate.get(source, ()):
+                if not la <= lookaheads[key]:
+                    lookaheads[key].update(la)
+                    worklist.append(key)
+
+        #
+        #  The tables
+        #
+        shift = self.symbits
+        action, goto = {}, {}
+        for state, edges in enumerate(trans):
+            for sym, target in edges.items():
+                key = (state << shift) | sym
+                if nonterminal[sym]:
+                    goto[key] = target
+                else:
+                    action[key] = target
+        for (state, (rule, pos)), la in lookaheads.items():
+            if pos < len(rule_rhs[rule]):
+                continue
+            for sym in la:
+                key = (state << shift) | sym
+                if key in action and action[key] != -1 - rule:
+                    action[key] = None
+                else:
+                    action[key] = -1 - rule
+        bof = self.sym2id[self._BOF]
+        lengths = [
+            len([sym for sym in rhs if not (self.sym_nullable[sym] or sym == bof)])
+            for rhs in rule_rhs
+        ]
+        self.lr_tables = (action, goto, lengths)
+
+    def recognizeLR(self, tokens):
+        """Recognize _tokens_ with the LALR(1) tables of makeLRTables().
+        Return the derivation found, as a list of the rule numbers
+        reduced by in order, with -1 for each token shifted; see
+        replayLR().  Return None on a conflict or a syntax error, or if
+        self.reduce_is_invalid() rejects a reduction, for the Earley
+        parser to take over.  No rule actions are run."""
+        if self.lr_tables is None:
+            self.makeLRTables()
+            if self.compiled:
+                self.shareTables()
+        action, goto, lengths = self.lr_tables
+        rule_lhs = self.rule_lhs
+        shift = self.symbits
+        start = self.sym2id[self._START]
+        checked = self.reduce_checked
+        # Per stack entry: its state, and the token and the place in
+        # the derivation where what it stands for begins
+        state = 0
+        states, firsts, marks = [state], [0], [0]
+        derivation = []
+        n = len(tokens)
+        i = 0
+        sym = self.tokenSym(tokens[0]) if n else 0
+        while 1:
+            if sym is None:
+                return None
+            act = action.get((state << shift) | sym)
+            if act is None:
+                return None
+            if act >= 0:
+                state = act
+                states.append(state)
+                firsts.append(i)
+                marks.append(len(derivation))
+                derivation.append(-1)
+                i += 1
+                sym = self.tokenSym(tokens[i]) if i < n else 0
+                continue
+            rule = -1 - act
+            count = lengths[rule]
+            if count:
+                first, mark = firsts[-count], marks[-count]
+                del states[-count:], firsts[-count:], marks[-count:]
+            else:
+                first, mark = i, len(derivation)
+            lhs = rule_lhs[rule]
+            if lhs in checked and self.checkReduceLR(rule, derivation[mark:], first, i):
+                return None
+            derivation.append(rule)
+            if lhs == start:
+                return derivation
+            state = goto[(states[-1] << shift) | lhs]
+            states.append(state)
+            firsts.append(first)
+            marks.append(mark)
+
+    def checkReduceLR(self, rule, derivation, first, i):
+        """Return True if self.reduce_is_invalid() rejects reducing by
+        rule number _rule_ the tokens _first_ to _i_, derived by
+        _derivation_; checkReduce() for recognizeLR()."""
+        named_rule = self.id2rule[rule]
+        lhs = named_rule[0]
+        if self.check_reduce[lhs] == "AST":
+            rhs = self.rule_rhs[rule]
+            ast = self.lrArgs(rule, self.replayLR(derivation, self.tokens, first))
+            if rhs and self.istail(self.sym_names[rhs[-1]]):
+                ast = ast[:-1] + ast[-1]
+        else:
+            ast = None
+        invalid = self.reduce_is_invalid(named_rule, ast, self.tokens, first, i)
+        if invalid and self.debug["reduce"]:
+            print("Reduce %s invalid by check" % lhs)
+        return invalid
+
+    def lrArgs(self, rule, args):
+        """Return the arguments for the action of rule number _rule_,
+        given _args_, those of its symbols that are on the LR stack:
+        \\e_ symbols are derived and |- is None."""
+        if len(args) == len(self.rule_rhs[rule]):
+            return args
+        attr = []
+        args = iter(args)
+        bof = self.sym2id[self._BOF]
+        for sym in self.rule_rhs[rule]:
+            if sym == bof:
+                attr.append(None)
+            elif self.sym_nullable[sym]:
+                attr.append(self.deriveEpsilon(sym))
+            else:
+                attr.append(next(args))
+        return attr
+
+    def replayLR(self, derivation, tokens, k):
+        """Run the rule actions for _derivation_, from recognizeLR(),
+        whose first token is number _k_, and return the list of values
+        it leaves on the stack."""
+        values = []
+        lengths, rule_action = self.lr_tables[2], self.rule_action
+        for rule in derivation:
+            if rule < 0:
+                values.append(tokens[k])
+                k += 1
+                continue
+            count = lengths[rule]
+            if count:
+                args = values[-count:]
+                del values[-count:]
+            else:
+                args = []
+            values.append(rule_action[rule](self.lrArgs(rule, args)))
+        return values
+
+    def predecessor(self, k, item, cause, rule):
+        """Return the item that _item_ of Earley set _k_ was reached
+        from via _cause_ and _rule_; see add().  The predecessor is in
+        set k - 1 when the item came from a scan (cause is -1), and in
+        the parent set of the cause otherwise."""
+        if item in self.leo_links[k]:
+            self.expandLeo(k, item)
+        links = self.links[k][item]
+        for j in range(0, len(links), 3):
+            if links[j + 1] == cause and links[j + 2] == rule:
+                return links[j]
         assert 0
 
-    def causal(self, key):
-        links = self.links[key]
-        if len(links) == 1:
-            return links[0][1]
+    def causal(self, k, item):
+        """Return the (cause, rule) pair of the link of _item_ in Earley
+        set _k_ used to build the parse tree."""
+        if item in self.leo_links[k]:
+            self.expandLeo(k, item)
+        links = self.links[k][item]
+        if len(links) == 3:
+            return links[1], links[2]
         choices = []
         rule2cause = {}
-        for p, c in links:
-            rule = c[2]
+        for j in range(0, len(links), 3):
+            rule = self.id2rule[links[j + 2]]
             choices.append(rule)
-            rule2cause[rule] = c
-        return rule2cause[self.ambiguity(choices)]
+            rule2cause[rule] = links[j + 1]
+        rule = self.ambiguity(choices)
+        return rule2cause[rule], self.rule2id[rule]
+
+    def chooseRule(self, rules):
+        """Pick among rule numbers _rules_ using ambiguity(), which
+        works on the rules themselves."""
+        if len(rules) == 1:
+            return rules[0]
+        return self.rule2id[self.ambiguity([self.id2rule[rule] for rule in rules])]
 
     def deriveEpsilon(self, nt):
-        if len(self.newrules[nt]) > 1:
-            rule = self.ambiguity(self.newrules[nt])
-        else:
-            rule = self.newrules[nt][0]
-        # print(rule) # debug
+        rule = self.chooseRule(self.lhs2rules[nt])
+        # print(self.id2rule[rule]) # debug
 
-        rhs = rule[1]
+        rhs = self.rule_rhs[rule]
         attr = [None] * len(rhs)
 
         for i in range(len(rhs) - 1, -1, -1):
             attr[i] = self.deriveEpsilon(rhs[i])
-        return self.rule2func[self.new2old[rule]](attr)
-
-    def buildTree(self, nt, item, tokens, k):
-        # Stack elements: (non-terminal, item, token index, parent index, attributes, rule)
+        return self.rule_action[rule](attr)
+
+    def buildTree(self, nt, item, tokens, k, subtrees=None):
+        # Stack elements: (non-terminal, item, token index, parent key, attributes, rule)
+        # Non-terminals and rules are the numbers given by numberRules().
+        # The parent key of a subtree is (non-terminal, item, token index)
+        # as first pushed.  If _subtrees_ is given, each subtree built is
+        # entered there under its key, and those already there are used
+        # as they are; see reparse().
         stack = [(nt, item, k, None, [], None)]
+        states, nonterminal, nullsym = self.states, self.sym_nonterminal, self.sym_nullable
+        rule_lhs, rule_rhs, rule_action = self.rule_lhs, self.rule_rhs, self.rule_action
+        bof = self.sym2id[self._BOF]
         while stack:
             nt, item, k, parent_idx, attr, rule = stack.pop()
-            state, parent = item
 
             # Find applicable rules if not already given
             if rule is None:
-                choices = [rule for rule in self.states[state].complete if rule[0] == nt]
-                rule = choices[0] if len(choices) == 1 else self.ambiguity(choices)
-            rhs = rule[1]
+                complete = states[item & _STATE_MASK].complete
+                rule = self.chooseRule(
+                    [rule for rule in complete if rule_lhs[rule] == nt]
+                )
+            rhs = rule_rhs[rule]
 
             # Process symbols in reverse order, skipping over those already completed
             for i in range(len(rhs) - 1 - len(attr), -1, -1):
                 sym = rhs[i]
-                if sym not in self.newrules:
-                    if sym != self._BOF:
+                if not nonterminal[sym]:
+                    if sym != bof:
                         attr.append(tokens[k - 1])
-                        key = (item, k)
-                        item, k = self.predecessor(key, None)
+                        item = self.predecessor(k, item, -1, -1)
+                        k -= 1
                     else:
                         attr.append(None)
                     continue
 
-                if self._NULLABLE == sym[0:len(self._NULLABLE)]:
+                if nullsym[sym]:
                     attr.append(self.deriveEpsilon(sym))
                     continue
 
-                key = (item, k)
-                why = self.causal(key)
-                if why:
-                    item, k = self.predecessor(key, why)
+                cause, cause_rule = self.causal(k, item)
+                if cause >= 0:
+                    key = (sym, cause, k)
+                    item = self.predecessor(k, item, cause, cause_rule)
+                    if subtrees is not None and key in subtrees:
+                        attr.append(subtrees[key])
+                        k = cause >> _STATE_BITS
+                        continue
                     # Push the current state back onto the stack with updated attributes and rule
-                    stack.append((nt, item, k, parent_idx, attr, rule))
+                    stack.append((nt, item, cause >> _STATE_BITS, parent_idx, attr, rule))
                     # Push the new state onto the stack
-                    stack.append((sym, why[0], why[1], k, [], None))
+                    stack.append((sym, cause, k, key, [], None))
                     break  # Break the loop to let the stack process the new state
             else:
                 # If we've processed all symbols, construct the node
-                node = self.rule2func[self.new2old[rule]](attr[::-1])
+                node = rule_action[rule](attr[::-1])
+                if subtrees is not None and parent_idx is not None:
+                    subtrees[parent_idx] = node
                 if parent_idx is not None:  # If there's a parent, update its attributes
                     parent_attr = stack[-1][-2]
                     parent_attr.append(node)
@@ -879,16 +3509,42 @@ class GenericParser(object):
         #  appears in >1 method.  Also undefined results if rules
         #  causing the ambiguity appear in the same method.
         #
-        sortlist = []
-        name2index = {}
-        for i in range(len(rules)):
-            lhs, rhs = rule = rules[i]
-            name = self.rule2name[self.new2old[rule]]
-            sortlist.append((len(rhs), name))
-            name2index[name] = i
-        sortlist.sort()
-        list = [a_b[1] for a_b in sortlist]
-        return rules[name2index[self.resolve(list)]]
+        if not [rule for rule in rules if rule in self.unit_chains]:
+            sortlist = []
+            name2index = {}
+            for i in range(len(rules)):
+                lhs, rhs = rule = rules[i]
+                name = self.rule2name[self.new2old[rule]]
+                sortlist.append((len(rhs), name))
+                name2index[name] = i
+            sortlist.sort()
+            names = [a_b[1] for a_b in sortlist]
+            return rules[name2index[self.resolve(names)]]
+
+        #  Rules made by removeUnitRules() are resolved as the unit
+        #  rules they stand for would have been: first among the
+        #  rules of their lhs, then among those of the next
+        #  nonterminal in the chain, and so on.
+        chains = [self.unit_chains.get(rule, [rule]) for rule in rules]
+        choices = list(range(len(rules)))
+        level = 0
+        # The same rule can be among the choices more than once
+        while len(choices) > 1 and level < len(chains[choices[0]]):
+            sortlist = []
+            groups, name2rule = {}, {}
+            for i in choices:
+                rule = chains[i][level]
+                name = self.rule2name[self.new2old[rule]]
+                if rule not in groups:
+                    groups[rule] = []
+                    sortlist.append((len(rule[1]), name))
+                groups[rule].append(i)
+                name2rule[name] = rule
+            sortlist.sort()
+            names = [a_b[1] for a_b in sortlist]
+            choices = groups[name2rule[self.resolve(names)]]
+            level += 1
+        return rules[choices[0]]
 
     def resolve(self, rule: list):
         """
@@ -906,6 +3562,47 @@ class GenericParser(object):
             out.write("%s\n" % rule2str(rule[0]))
         return
 
+    def generate_module(self, out=sys.stdout):
+        """
+        Write out the source of a Python module that has this parser's
+        fully built state machine in it as literal tables.  Importing
+        the module makes the tables available to every parser of the
+        same grammar, as compile() does, so they skip table building
+        altogether; the module's Parser class is this parser's class.
+
+        The tables are looked up under grammar_fingerprint(), so after
+        the grammar changes, the module is just not used until it is
+        generated again.  The parser's class must be importable from
+        its module.
+        """
+        cls = self.__class__
+        if cls.__module__ == "__main__" or "." in getattr(cls, "__qualname__", ""):
+            raise TypeError("Can't import %s from its module" % cls.__name__)
+        self.compile()
+        out.write(
+            '"""\nState machine tables for %s.%s, generated by\n'
+            'GenericParser.generate_module().  Don\'t edit.\n"""\n\n'
+            % (cls.__module__, cls.__name__)
+        )
+        out.write("from spark_parser.spark import _State, _add_compiled\n")
+        out.write("from %s import %s\n\n" % (cls.__module__, cls.__name__))
+        out.write("FINGERPRINT = %r\n\n" % self.grammar_fingerprint())
+        out.write("_tables = {}\n")
+        for name in self._TABLES:
+            if name == "states":
+                continue
+            out.write("_tables[%r] = %r\n" % (name, getattr(self, name)))
+        out.write("_tables['states'] = states = []\n")
+        out.write(
+            "for items, T, N, complete in %r:\n"
+            % ([(s.items, s.T, s.N, s.complete) for s in self.states],)
+        )
+        out.write("    state = _State(len(states), items)\n")
+        out.write("    state.T, state.N, state.complete = T, N, complete\n")
+        out.write("    states.append(state)\n")
+        out.write("_add_compiled(FINGERPRINT, _tables)\n\n")
+        out.write("Parser = %s\n" % cls.__name__)
+
     def check_grammar(self, ok_start_symbols=set(), out=sys.stderr):
         """
         Check grammar for:
@@ -1021,24 +3718,26 @@ class GenericParser(object):
             self.coverage_path.write("-" * 40 + "\n")
 
     def reduce_ast(self, rule, tokens, item, k, sets):
-        rhs = rule[1]
+        rhs = self.rule_rhs[self.rule2id[rule]]
         ast = [None] * len(rhs)
         for i in range(len(rhs) - 1, -1, -1):
             sym = rhs[i]
-            if sym not in self.newrules:
-                if sym != self._BOF:
+            if not self.sym_nonterminal[sym]:
+                if sym != self.sym2id[self._BOF]:
                     ast[i] = tokens[k - 1]
-                    key = (item, k)
-                    item, k = self.predecessor(key, None)
-            elif self._NULLABLE == sym[0 : len(self._NULLABLE)]:
+                    item = self.predecessor(k, item, -1, -1)
+                    k -= 1
+            elif self.sym_nullable[sym]:
                 ast[i] = self.deriveEpsilon(sym)
             else:
-                key = (item, k)
-                why = self.causal(key)
-                ast[i] = self.buildTree(sym, why[0], tokens, why[1])
-                item, k = self.predecessor(key, why)
+                cause, cause_rule = self.causal(k, item)
+                ast[i] = self.buildTree(sym, cause, tokens, k)
+                item = self.predecessor(k, item, cause, cause_rule)
+                k = cause >> _STATE_BITS
                 pass
             pass
+        if rhs and self.istail(self.sym_names[rhs[-1]]):
+            ast = ast[:-1] + ast[-1]
         return ast
 
 
@@ -1053,12 +3752,16 @@ class GenericParser(object):
 
 
 class GenericASTBuilder(GenericParser):
-    def __init__(self, AST, start, debug=DEFAULT_DEBUG):
+    def __init__(self, AST, start, debug=DEFAULT_DEBUG, cache_dir=None):
         if "SPARK_PARSER_COVERAGE" in os.environ:
             coverage_path = os.environ["SPARK_PARSER_COVERAGE"]
         else:
             coverage_path = None
-        GenericParser.__init__(self, start, debug=debug, coverage_path=coverage_path)
+        if cache_dir is None:
+            cache_dir = os.environ.get("SPARK_PARSER_CACHE")
+        GenericParser.__init__(
+            self, start, debug=debug, coverage_path=coverage_path, cache_dir=cache_dir
+        )
         self.AST = AST
 
     def preprocess(self, rule, func):
@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+
+from test_spark import ExprParser, scan_expression
+
+
+class TestAsync(unittest.TestCase):
+    def test_parse_async(self):
+        parser = ExprParser()
+        tokens = scan_expression("1+2*3+4*5*6+7")
+        tree = ExprParser().parse(tokens)
+
+        async def scanned():
+            for token in tokens:
+                yield token
+
+        async def parse():
+            turns = []
+
+            async def other():
+                while True:
+                    turns.append(None)
+                    await asyncio.sleep(0)
+
+            task = asyncio.ensure_future(other())
+            trees = [
+                await parser.parse_async(tokens, yield_every=2),
+                await parser.parse_async(scanned(), yield_ms=0),
+            ]
+            task.cancel()
+            return trees, len(turns)
+
+        trees, turns = asyncio.run(parse())
+        self.assertEqual(trees, [tree, tree])
+        # The other task ran while parsing went on
+        self.assertTrue(turns > len(tokens) // 2)
+
+        async def cancel():
+            long = scan_expression("+".join(["1"] * 1000))
+            task = asyncio.ensure_future(parser.parse_async(long, yield_every=1))
+            await asyncio.sleep(0)
+            task.cancel()
+            await task
+
+        self.assertRaises(asyncio.CancelledError, asyncio.run, cancel())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from spark_parser.spark import _MAX_COMPILED_TABLES, _compiled_tables
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        _compiled_tables.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def cached_parser(self):
+        parser = ExprParser()
+        parser.cache_dir = self.cache_dir
+        return parser
+
+    def test_cache(self):
+        tokens = scan_expression("1+2*3")
+        parser = self.cached_parser()
+        tree = parser.parse(tokens)
+        self.assertTrue(parser.compiled)
+        # Writing the cache leaves the live states alone
+        self.assertTrue(all(hasattr(s, "items") for s in parser.states))
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [os.path.basename(parser.cachePath())])
+
+        parser = self.cached_parser()
+        self.assertTrue(parser.loadTables())
+        _compiled_tables.clear()
+        self.assertTrue(parser.findTables())
+        self.assertEqual(tree, parser.parse(tokens))
+
+    def test_fingerprint(self):
+        parser = self.cached_parser()
+        parser.compile()
+        fingerprint = parser.grammar_fingerprint()
+        self.assertEqual(fingerprint, ExprParser().grammar_fingerprint())
+
+        parser.addRule("expr ::= expr SUB_OP term", lambda self, args: None)
+        self.assertNotEqual(fingerprint, parser.grammar_fingerprint())
+        self.assertFalse(parser.loadTables())
+        parser.compile()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_corrupt(self):
+        parser = self.cached_parser()
+        with open(parser.cachePath(), "wb") as fp:
+            fp.write(b"garbage")
+        self.assertFalse(parser.loadTables())
+        tokens = scan_expression("1+2")
+        self.assertEqual(ExprParser().parse(tokens), parser.parse(tokens))
+
+    def test_shared(self):
+        first = ExprParser()
+        first.compile()
+        second = CheckedExprParser()
+        tokens = scan_expression("1+2*3")
+        self.assertEqual(first.parse(tokens), second.parse(tokens))
+        self.assertTrue(second.compiled)
+        self.assertTrue(second.states is first.states)
+        self.assertTrue(second.edges is first.edges)
+        # ... but each has its own reduction actions and settings
+        self.assertTrue(
+            any(getattr(f, "__self__", None) is second for f in second.rule_action)
+        )
+        self.assertRaises(SyntaxError, second.parse, scan_expression("1*0"))
+        first.parse(scan_expression("1*0"))
+
+        # A different grammar doesn't share
+        other = ExprParser()
+        other.addRule("expr ::= expr SUB_OP term", lambda self, args: None)
+        other.compile()
+        self.assertFalse(other.states is first.states)
+        # ... nor does a different limit on nullable symbols
+        other = ExprParser()
+        other._MAX_NULLABLE = 2
+        self.assertNotEqual(other.grammar_fingerprint(), first.grammar_fingerprint())
+
+        # Only the most recently used grammars are kept
+        for n in range(_MAX_COMPILED_TABLES + 5):
+            fork = first.fork()
+            fork.addRule("term ::= term MULT_OP%d factor" % n, lambda self, args: None)
+            fork.compile()
+        self.assertEqual(len(_compiled_tables), _MAX_COMPILED_TABLES)
+        self.assertFalse(first.grammar_fingerprint() in _compiled_tables)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import pickle
+import unittest
+
+from test_spark import ExprParser, scan_expression
+
+
+class CheckedExprParser(ExprParser):
+    """ExprParser that refuses to multiply by 0"""
+
+    def __init__(self):
+        ExprParser.__init__(self)
+        self.check_reduce["term"] = "AST"
+
+    def reduce_is_invalid(self, rule, ast, tokens, first, last):
+        return rule == ("term", ("term", "MULT_OP", "factor")) and ast[2][0].attr == "0"
+
+    def error(self, tokens, index):
+        raise SyntaxError(index)
+
+
+class TestCompile(unittest.TestCase):
+    def test_compile(self):
+        lazy = ExprParser()
+        compiled = ExprParser()
+        compiled.compile()
+        self.assertTrue(compiled.compiled)
+        self.assertFalse(None in compiled.edges.values())
+        for data in ("1", "1+2", "1+2*3", "4*5+6*7*8"):
+            tokens = scan_expression(data)
+            self.assertEqual(lazy.parse(tokens), compiled.parse(tokens))
+        self.assertEqual(len(lazy.states), len(compiled.states))
+
+        # Changing the grammar goes back to building states lazily
+        compiled.addRule("expr ::= expr SUB_OP term", lambda self, args: None)
+        self.assertTrue(compiled.ruleschanged)
+        compiled.compile()
+        self.assertTrue(compiled.compiled)
+
+    def test_check_reduce(self):
+        parser = CheckedExprParser()
+        parser.compile()
+        parser.parse(scan_expression("1*2"))
+        self.assertRaises(SyntaxError, parser.parse, scan_expression("1*0"))
+
+    def test_pickle(self):
+        parser = ExprParser()
+        tokens = scan_expression("1+2*3")
+        tree = parser.parse(tokens)
+        copy = pickle.loads(pickle.dumps(parser))
+        self.assertTrue(copy.compiled)
+        self.assertEqual(tree, copy.parse(tokens))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+if __name__ == "__main__":
+    unittest.main()
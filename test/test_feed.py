@@ -0,0 +1,49 @@
+import unittest
+
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+
+
+class TestFeed(unittest.TestCase):
+    def test_feed(self):
+        lazy = ExprParser()
+        compiled = ExprParser()
+        compiled.compile()
+        for parser in (lazy, compiled):
+            for data in ("1", "1+2*3", "4*5+6*7*8"):
+                tokens = scan_expression(data)
+                for token in tokens:
+                    parser.feed(token)
+                self.assertEqual(parser.finish(), ExprParser().parse(tokens))
+                self.assertTrue(parser.links is None)
+
+        # Two inputs fed at once, in sessions
+        first, second = compiled.session(), compiled.session()
+        for token1, token2 in zip(scan_expression("1+2"), scan_expression("3*4")):
+            first.feed(token1)
+            second.feed(token2)
+        self.assertEqual(first.finish(), ExprParser().parse(scan_expression("1+2")))
+        self.assertEqual(second.finish(), ExprParser().parse(scan_expression("3*4")))
+
+        # A syntax error comes as soon as the token is fed ...
+        parser = CheckedExprParser()
+        tokens = scan_expression("1+*2")
+        parser.feed(tokens[0])
+        parser.feed(tokens[1])
+        with self.assertRaises(SyntaxError) as cm:
+            parser.feed(tokens[2])
+        self.assertEqual(cm.exception.args, (2,))
+        # ... or when the input ends too soon
+        for token in scan_expression("1+"):
+            parser.feed(token)
+        with self.assertRaises(SyntaxError) as cm:
+            parser.finish()
+        self.assertEqual(cm.exception.args, (1,))
+        # reduce_is_invalid() checks are made as the tokens come
+        for token in scan_expression("1*0"):
+            parser.feed(token)
+        self.assertRaises(SyntaxError, parser.finish)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+from spark_parser import AST, GenericASTBuilder
+from spark_parser.scanner import GenericToken
+from spark_parser.spark import GenericParser
+from test_compile import CheckedExprParser
+from test_spark import scan_expression
+
+
+def p_power(args):
+    return AST("power", [args[0], args[3]])
+
+
+class ListBuilder(GenericASTBuilder):
+    def __init__(self):
+        GenericASTBuilder.__init__(self, AST, "items")
+
+    def p_items(self, args):
+        """
+        items ::= items ITEM
+        items ::= ITEM
+        """
+
+
+class Optional(GenericParser):
+    def p_rules(self, args):
+        """
+        s ::= X
+        s ::=
+        """
+
+    def error(self, tokens, index):
+        raise SyntaxError(index)
+
+
+class TestFork(unittest.TestCase):
+    def test_fork(self):
+        parser = CheckedExprParser()
+        parser.compile()
+        fork = parser.fork()
+        self.assertTrue(fork.states is parser.states)
+
+        fork.addRule("factor ::= factor MULT_OP MULT_OP INTEGER", p_power)
+        tokens = scan_expression("1+2**3")
+        tree = fork.parse(tokens)
+        self.assertEqual(tree[1][0].kind, "power")
+        self.assertRaises(SyntaxError, parser.parse, tokens)
+
+        # Only the states affected by the new rule were rebuilt
+        n = len(parser.states)
+        self.assertEqual(fork.states[:n], parser.states)
+        self.assertFalse(fork.edges is parser.edges)
+
+        # A fork built from scratch parses the same
+        fresh = CheckedExprParser()
+        fresh.addRule("factor ::= factor MULT_OP MULT_OP INTEGER", p_power)
+        self.assertEqual(tree, fresh.parse(tokens))
+        fork.compile()
+        self.assertEqual(tree, fork.parse(tokens))
+
+    def test_independent(self):
+        parser = CheckedExprParser()
+        fork = parser.fork()
+        fork.remove_rules("term ::= term MULT_OP factor")
+        self.assertRaises(SyntaxError, fork.parse, scan_expression("1*2"))
+        parser.parse(scan_expression("1*2"))
+
+        fork = parser.fork()
+        del fork.check_reduce["term"]
+        fork.parse(scan_expression("1*0"))
+        self.assertRaises(SyntaxError, parser.parse, scan_expression("1*0"))
+
+    def test_ast_builder(self):
+        parser = ListBuilder()
+        tokens = [GenericToken("ITEM", "a"), GenericToken("ITEM", "b")]
+        tree = parser.parse(tokens)
+        fork = parser.fork()
+        # The fork builds its nodes with its own methods
+        fork.nonterminal = lambda kind, args: AST("fork_" + kind, args)
+        self.assertEqual(fork.parse(tokens).kind, "fork_items")
+        self.assertEqual(parser.parse(tokens), tree)
+
+    def test_empty_start(self):
+        parser = Optional("s")
+        fork = parser.fork()
+        fork.remove_rules("s ::= X")
+        # s now only derives the empty string
+        for p in (fork, fork.fork()):
+            p.parse([])
+            self.assertRaises(SyntaxError, p.parse, [GenericToken("X", "x")])
+            self.assertEqual(p.recognize([GenericToken("X", "x")]), 0)
+            p.compile()
+        parser.parse([GenericToken("X", "x")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import io
+import unittest
+
+from spark_parser.spark import _compiled_tables
+from test_spark import ExprParser, scan_expression
+
+
+class TestGenerate(unittest.TestCase):
+    def test_generate_module(self):
+        parser = ExprParser()
+        out = io.StringIO()
+        parser.generate_module(out)
+        fingerprint = parser.grammar_fingerprint()
+        tables = _compiled_tables.pop(fingerprint)
+        self.addCleanup(_compiled_tables.__setitem__, fingerprint, tables)
+
+        module = {}
+        exec(out.getvalue(), module)
+        self.assertTrue(module["Parser"] is ExprParser)
+        tables = _compiled_tables[fingerprint]
+        self.assertTrue(tables is module["_tables"])
+        other = ExprParser()
+        tokens = scan_expression("1+2*3")
+        self.assertEqual(parser.parse(tokens), other.parse(tokens))
+        self.assertTrue(other.compiled)
+        self.assertTrue(other.edges is tables["edges"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+
+from spark_parser.scanner import GenericToken
+from spark_parser.spark import GenericParser
+
+
+class RightRecursive(GenericParser):
+    """Right-recursive lists, which check_grammar() warns about"""
+
+    leo = True
+
+    def p_rules(self, args):
+        """
+        stmts ::= stmt stmts
+        stmts ::= stmt
+        stmt ::= NAME SEMI
+        stmt ::= NAME EQ expr SEMI
+        expr ::= NAME PLUS expr
+        expr ::= NAME
+        """
+        return (args[0] if len(args) == 1 else tuple(args))
+
+
+class NoLeo(RightRecursive):
+    leo = False
+
+
+class Tangled(GenericParser):
+    """Right recursion where rules of one method tie in ambiguity()"""
+
+    def p_m0(self, args):
+        """
+        a ::= X
+        a ::= b
+        """
+        return ("m0",) + tuple(args)
+
+    def p_m1(self, args):
+        """
+        a ::= Y a
+        b ::= X X
+        b ::= Y b
+        """
+        return ("m1",) + tuple(args)
+
+    def p_m2(self, args):
+        """
+        a ::= X a Y
+        b ::= Y Y
+        """
+        return ("m2",) + tuple(args)
+
+
+class TangledLeo(Tangled):
+    leo = True
+
+
+def tokens(kinds):
+    return [GenericToken(kind, kind.lower()) for kind in kinds.split()]
+
+
+def nlinks(parser, data):
+    return parser.parse_result(data).stats["links"]
+
+
+class TestLeo(unittest.TestCase):
+    def test_trees(self):
+        for data in (
+            "NAME SEMI",
+            "NAME SEMI NAME SEMI NAME EQ NAME SEMI",
+            "NAME EQ NAME PLUS NAME PLUS NAME SEMI NAME SEMI",
+        ):
+            self.assertEqual(
+                RightRecursive("stmts").parse(tokens(data)),
+                NoLeo("stmts").parse(tokens(data)),
+            )
+
+        parser = RightRecursive("stmts")
+        parser.compile()
+        data = tokens("NAME EQ NAME PLUS NAME SEMI " * 10)
+        self.assertEqual(parser.parse(data), NoLeo("stmts").parse(data))
+
+    def test_default(self):
+        # Leo's optimization is off unless asked for, since on ties it
+        # can pick a different tree
+        data = tokens("X Y Y Y Y Y")
+        x, y = data[0], data[1]
+        self.assertEqual(
+            Tangled("a").parse(data),
+            ("m2", x, ("m0", ("m1", y, ("m1", y, ("m2", y, y)))), y),
+        )
+        for n in range(1, 6):
+            data = tokens("Y " * n + "X")
+            self.assertEqual(Tangled("a").parse(data), TangledLeo("a").parse(data))
+
+    def test_linear(self):
+        leo, noleo = RightRecursive("stmts"), NoLeo("stmts")
+        short = tokens("NAME SEMI " * 50)
+        long = tokens("NAME SEMI " * 100)
+        n = nlinks(leo, short)
+        self.assertTrue(nlinks(leo, long) <= 2 * n + 10)
+        n = nlinks(noleo, short)
+        self.assertTrue(nlinks(noleo, long) > 3 * n)
+
+
+if __name__ == "__main__":
+    unittest.main()
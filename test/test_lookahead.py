@@ -0,0 +1,53 @@
+import unittest
+
+from spark_parser.scanner import GenericToken
+from spark_parser.spark import GenericParser, PrefixCache
+from test_spark import ExprParser, scan_expression
+
+
+class Prefixed(GenericToken):
+    """A token equal to any terminal its kind starts with"""
+
+    def __eq__(self, o):
+        return self.kind.startswith(o)
+
+    __hash__ = GenericToken.__hash__
+
+
+class CallParser(GenericParser):
+    def p_rules(self, args):
+        """
+        a ::= X CALL
+        a ::= Y CALL_1
+        """
+        return tuple(args)
+
+
+class TestLookahead(unittest.TestCase):
+    def test_lookahead(self):
+        tokens = scan_expression("1+2*3+4*5*6+7")
+        filtered = ExprParser()
+        unfiltered = ExprParser()
+        unfiltered.lookahead = False
+        result = filtered.parse_result(tokens)
+        unresult = unfiltered.parse_result(tokens)
+        self.assertEqual(result.tree, unresult.tree)
+        # Items that can't go on with the next token aren't added
+        self.assertTrue(result.stats["links"] < unresult.stats["links"])
+        filtered.compile()
+        self.assertEqual(filtered.parse(tokens), unfiltered.parse(tokens))
+
+        # A token that is equal to more than one terminal isn't taken
+        # to be just the one its kind names
+        tokens = [Prefixed("X"), Prefixed("CALL_1")]
+        parser = CallParser("a")
+        self.assertEqual(parser.parse(tokens), tuple(tokens))
+        parser.compile()
+        parser.memoize_sets = True
+        parser.prefix_cache = PrefixCache()
+        for _ in range(3):
+            self.assertEqual(parser.parse(tokens), tuple(tokens))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import tempfile
+import unittest
+
+from spark_parser.spark import GenericParser
+
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+from test_tables import Ambiguous, Options, tokens
+
+
+def recording(cls):
+    """A subclass of _cls_ that parses with LALR(1) tables and notes
+    whether the last parse could use them"""
+
+    class Recording(cls):
+        lr = True
+
+        def recognizeLR(self, tokens):
+            derivation = GenericParser.recognizeLR(self, tokens)
+            self.deterministic = derivation is not None
+            return derivation
+
+    return Recording
+
+
+class Assign(GenericParser):
+    """LALR(1), but not SLR(1)"""
+
+    def p_rules(self, args):
+        """
+        s ::= l EQ r
+        s ::= r
+        l ::= STAR r
+        l ::= ID
+        r ::= l
+        """
+        return tuple(args)
+
+
+class TestLR(unittest.TestCase):
+    def test_lalr(self):
+        parser = recording(Assign)("s")
+        earley = Assign("s")
+        parser.compile()
+        self.assertFalse(None in parser.lr_tables[0].values())
+        for data in ("ID", "ID EQ ID", "STAR ID EQ STAR STAR ID", "STAR ID"):
+            self.assertEqual(parser.parse(tokens(data)), earley.parse(tokens(data)))
+            self.assertTrue(parser.deterministic)
+        result = parser.parse_result(tokens("ID EQ ID"))
+        self.assertTrue(result.stats["lr"])
+        self.assertEqual(result.stats["sets"], 0)
+
+    def test_trees(self):
+        parser = recording(ExprParser)()
+        earley = ExprParser()
+        for data in ("1", "1+2", "1+2*3", "4*5+6*7*8"):
+            expr = scan_expression(data)
+            self.assertEqual(parser.parse(expr), earley.parse(expr))
+            self.assertTrue(parser.deterministic)
+
+        # \e_ symbols, and rules split by splitRule()
+        parser = recording(Options)("stmt")
+        earley = Options("stmt")
+        for data in ("NAME", "A NAME", "B NAME C E G", "A B NAME C D E F G H"):
+            self.assertEqual(parser.parse(tokens(data)), earley.parse(tokens(data)))
+            self.assertTrue(parser.deterministic)
+
+    def test_fallback(self):
+        parser = recording(Ambiguous)("expr")
+        parser.resolved = []
+        earley = Ambiguous("expr")
+        earley.resolved = []
+        data = tokens("NUMBER ADD MINUS NUMBER")
+        self.assertEqual(parser.parse(data), earley.parse(data))
+        self.assertTrue(parser.deterministic)
+        # Ambiguous: the tables have a conflict on the second ADD
+        data = tokens("NUMBER ADD NUMBER ADD NUMBER")
+        self.assertEqual(parser.parse(data), earley.parse(data))
+        self.assertFalse(parser.deterministic)
+
+        # A reduction rejected by reduce_is_invalid() is left to Earley
+        parser = recording(CheckedExprParser)()
+        parser.parse(scan_expression("1*2"))
+        self.assertTrue(parser.deterministic)
+        self.assertRaises(SyntaxError, parser.parse, scan_expression("1*0"))
+        self.assertFalse(parser.deterministic)
+
+    def test_shared(self):
+        parser = recording(Assign)("s")
+        parser.compile()
+        # Another parser of the grammar takes the tables over
+        other = recording(Assign)("s")
+        other.parse(tokens("ID EQ ID"))
+        self.assertTrue(other.deterministic)
+        self.assertTrue(other.lr_tables is parser.lr_tables)
+
+        # ... also when they were built after the state machine was
+        # shared without them
+        parsers = []
+        for cls in (ExprParser, recording(ExprParser), recording(ExprParser)):
+            parser = cls()
+            parser.addRule("expr ::= expr SUB_OP term", parser.p_expr_add_term)
+            parsers.append(parser)
+        earley, parser, other = parsers
+        earley.compile()
+        self.assertTrue(earley.lr_tables is None)
+        parser.parse(scan_expression("1+2"))
+        self.assertTrue(parser.deterministic)
+        other.compile()
+        self.assertTrue(other.lr_tables is parser.lr_tables)
+
+        # ... and saved with them in the cache directory
+        with tempfile.TemporaryDirectory() as cache_dir:
+            parser = recording(Assign)("s")
+            parser.addRule("s ::= r EQ r", parser.p_rules)
+            parser.cache_dir = cache_dir
+            parser.compile()
+            tables = parser.loadTables()
+            self.assertEqual(tables["lr_tables"], parser.lr_tables)
+
+
+if __name__ == "__main__":
+    unittest.main()
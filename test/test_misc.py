@@ -1,7 +1,8 @@
 import unittest
-from spark_parser.spark import GenericParser
+from spark_parser.spark import GenericParser, _parsed_rules
 
 from io import StringIO
+from test_spark import ExprScanner
 
 class Rules(GenericParser):
     """Testing duplicate rules"""
@@ -96,6 +97,25 @@ x ::= TOKEN
                           (('opt_period', ('PERIOD',)), 'rules'), ])
         self.assertEqual(set(['opt_period']),  parser.optional_nt)
 
+    def test_class_cache(self):
+        # Rules are collected once per class, but each parser gets its own
+        first = Rules('x')
+        second = Rules('x')
+        self.assertEqual(first.rules, second.rules)
+        self.assertFalse(first.rules['stmts'] is second.rules['stmts'])
+        self.assertTrue(second.rule2func[('x', ('TOKEN',))].__self__ is second)
+        second.remove_rules('x ::= TOKEN')
+        self.assertEqual(first.rules['x'], [('x', ('TOKEN',))])
+        self.assertEqual(second.rules['x'], [])
+
+        # Rules added on their own, as fork() does for each change, aren't kept
+        first.addRule('x ::= TOKEN TOKEN', first.p_rules)
+        self.assertTrue(Rules.p_rules.__doc__ in _parsed_rules)
+        self.assertFalse('x ::= TOKEN TOKEN' in _parsed_rules)
+
+        # ... and so is the token pattern of a scanner
+        self.assertTrue(ExprScanner().re is ExprScanner().re)
+
 
 if __name__ == '__main__':
     unittest.main()
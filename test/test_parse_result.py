@@ -0,0 +1,33 @@
+import unittest
+
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+
+
+class TestParseResult(unittest.TestCase):
+    def test_parse_result(self):
+        parser = ExprParser()
+        tokens = scan_expression("1+2*3")
+        result = parser.parse_result(tokens)
+        self.assertEqual(result.tree, ExprParser().parse(tokens))
+        self.assertEqual(result.stats["sets"], len(tokens) + 2)
+        self.assertTrue(result.stats["items"] >= result.stats["links"] > 0)
+        self.assertFalse(result.stats["lr"])
+        # The chart isn't kept ...
+        self.assertTrue(result.chart is None)
+        self.assertTrue(parser.links is None and parser.tokens is None)
+        # ... even if parsing fails
+        parser = CheckedExprParser()
+        self.assertRaises(SyntaxError, parser.parse, scan_expression("1*0"))
+        self.assertTrue(parser.links is None)
+
+        # ... unless asked for
+        result = parser.parse_result(tokens, keep_chart=True)
+        sets, links, leo_links = result.chart
+        self.assertEqual(len(sets), result.stats["sets"])
+        self.assertTrue(links is parser.links)
+        self.assertTrue(parser.tokens is tokens)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+from spark_parser.scanner import GenericToken
+from spark_parser.spark import GenericParser, PrefixCache, _STATE_MASK
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+
+
+class Statement(GenericParser):
+    def p_rules(self, args):
+        """
+        stmt ::= NAME args END
+        args ::= args NAME
+        args ::=
+        """
+        return tuple(args)
+
+
+class TestPrefixCache(unittest.TestCase):
+    def test_prefix_cache(self):
+        cache = PrefixCache(2)
+        parser = ExprParser()
+        parser.prefix_cache = cache
+        parser.compile()
+        parser.parse(scan_expression("1+2*3"))
+        # INTEGER ADD_OP INTEGER MULT_OP INTEGER are the same
+        tokens = scan_expression("4+5*6+7")
+        result = parser.parse_result(tokens)
+        self.assertEqual(result.stats["reused"], 5)
+        self.assertEqual(result.tree, ExprParser().parse(tokens))
+
+        # Other parsers of the grammar can use the cache too
+        other = ExprParser()
+        other.prefix_cache = cache
+        other.compile()
+        tokens = scan_expression("8*9")
+        result = other.parse_result(tokens)
+        self.assertEqual(result.stats["reused"], 1)
+        self.assertEqual(result.tree, ExprParser().parse(tokens))
+
+        # The least recently used parse is dropped
+        self.assertEqual(len(cache.charts), 2)
+        self.assertEqual(cache.lookup(parser.edges, [parser.sym2id["MULT_OP"]]), (None, 0))
+
+        # A token not in the grammar ends the prefix looked up
+        bogus = scan_expression("8*") + [GenericToken("BOGUS", "?")]
+        self.assertRaises(SystemExit, other.parse, bogus)
+
+        # A parse with no token types to look it up by isn't kept
+        small = PrefixCache(2)
+        first, second = {}, {}
+        small.add(first, [1], ([], [], []))
+        small.add(first, [None], ([], [], []))
+        self.assertEqual(len(small.charts), 1)
+        small.add(second, [1], ([], [], []))
+        small.add(second, [2], ([], [], []))
+        self.assertEqual(len(small.charts), 2)
+        self.assertEqual(small.lookup(second, [2, 3])[1], 1)
+        self.assertEqual(small.lookup(first, [1]), (None, 0))
+
+        # Parsers whose reductions are checked don't use it
+        checked = CheckedExprParser()
+        checked.prefix_cache = cache
+        self.assertEqual(checked.parse_result(tokens).stats["reused"], 0)
+
+        # Sets go into the cache filled in, so that parses in other
+        # threads only read them
+        parser = Statement("stmt")
+        parser.prefix_cache = PrefixCache()
+        parser.compile()
+        parser.parse([GenericToken("NAME"), GenericToken("END")])
+        sets = parser.prefix_cache.lookup(parser.edges, [parser.sym2id["NAME"]])[0][0]
+        for set in sets:
+            for item in set:
+                for lhs in parser.states[item & _STATE_MASK].N:
+                    self.assertTrue(lhs in set.waiting and lhs in set.leo)
+        inputs = [
+            scan_expression(data)
+            for data in ("1+2*3", "1+2*3+4", "1+2", "1*2*3", "1*2+3", "1")
+        ]
+        trees = [ExprParser().parse(tokens) for tokens in inputs]
+        for leo in (False, True):
+            parser = ExprParser()
+            parser.leo = leo
+            parser.prefix_cache = PrefixCache()
+            self.assertEqual(parser.parse_many(inputs * 50, max_workers=8), trees * 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+
+
+class TestRecognize(unittest.TestCase):
+    def test_recognize(self):
+        lazy = ExprParser()
+        compiled = ExprParser()
+        compiled.compile()
+        for parser in (lazy, compiled):
+            self.assertTrue(parser.recognize(scan_expression("1+2*3")) is True)
+            # No token can follow the +
+            self.assertEqual(parser.recognize(scan_expression("1+*2")), 2)
+            # The input ends too soon
+            self.assertEqual(parser.recognize(scan_expression("1+2*")), 4)
+
+        parser = CheckedExprParser()
+        self.assertTrue(parser.recognize(scan_expression("1*2")) is True)
+        self.assertEqual(parser.recognize(scan_expression("1*0")), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from test_spark import ExprParser, scan_expression
+
+
+class TestReparse(unittest.TestCase):
+    def test_reparse(self):
+        parser = ExprParser()
+        tokens = scan_expression("1+2*3+4*5+6")
+        result = parser.parse_result(tokens, keep_chart=True)
+        for start, end, data in (
+            (2, 3, "7"),  # the same number of tokens
+            (2, 3, "7*8+9"),  # more
+            (1, 5, ""),  # fewer
+            (len(tokens), len(tokens), "*2"),  # added at the end
+        ):
+            new = scan_expression(data)
+            expected = tokens[:start] + new + tokens[end:]
+            new_result = parser.reparse(result, start, end, new)
+            self.assertEqual(new_result.tree, ExprParser().parse(expected))
+            self.assertEqual(new_result.tokens, expected)
+            self.assertTrue(new_result.stats["reused"] >= start)
+        # The sets after "7" come out the same as before, and are reused
+        result = parser.reparse(result, 2, 3, scan_expression("7"))
+        self.assertTrue(result.stats["reused"] > 3)
+        # ... and the result can be reparsed in turn
+        tokens = result.tokens
+        result = parser.reparse(result, 6, 7, scan_expression("8*9"))
+        expected = tokens[:6] + scan_expression("8*9") + tokens[7:]
+        self.assertEqual(result.tree, ExprParser().parse(expected))
+
+        parser.reuse_subtrees = True
+        result = parser.parse_result(tokens, keep_chart=True)
+        new_result = parser.reparse(result, 6, 7, scan_expression("8"))
+        expected = tokens[:6] + scan_expression("8") + tokens[7:]
+        self.assertEqual(new_result.tree, ExprParser().parse(expected))
+        # The subtree for 1+7*3 is the one in the old tree
+        self.assertTrue(new_result.tree[0][0] is result.tree[0][0])
+        self.assertFalse(new_result.tree[0] is result.tree[0])
+
+        self.assertRaises(TypeError, parser.reparse, parser.parse_result(tokens), 0, 0, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
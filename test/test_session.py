@@ -0,0 +1,33 @@
+import unittest
+
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+
+
+class TestSession(unittest.TestCase):
+    def test_session(self):
+        parser = ExprParser()
+        inputs = [scan_expression(data) for data in ("1", "1+2", "1+2*3", "4*5+6*7*8")]
+        trees = [ExprParser().parse(tokens) for tokens in inputs]
+        self.assertEqual(parser.parse_many(inputs * 10, max_workers=4), trees * 10)
+        self.assertTrue(parser.compiled)
+
+        session = parser.session()
+        self.assertTrue(session.edges is parser.edges)
+        session.keep_chart = True
+        self.assertEqual(session.parse(inputs[2]), trees[2])
+        self.assertFalse(session.links is getattr(parser, "links", None))
+        self.assertTrue(session.first_sets is parser.first_sets)
+        self.assertFalse(session.set_memo is parser.set_memo)
+        self.assertFalse(session.set_shapes is parser.set_shapes)
+
+        # An exception in a parse comes out of parse_many()
+        self.assertRaises(
+            SyntaxError,
+            CheckedExprParser().parse_many,
+            [scan_expression("1*2"), scan_expression("1*0")],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from spark_parser.spark import _STATE_BITS, _EarleySet
+from test_compile import CheckedExprParser
+from test_spark import ExprParser, scan_expression
+
+
+class TestEarleySet(unittest.TestCase):
+    def test_membership(self):
+        item1, item2, item3 = 1, 2, (1 << _STATE_BITS) | 3
+        s = _EarleySet([item1, item2])
+        self.assertTrue(item1 in s)
+        self.assertFalse(item3 in s)
+        s.members.add(item3)
+        s.append(item3)
+        self.assertTrue(item3 in s)
+        # Insertion order is kept since the set is also a worklist
+        self.assertEqual(list(s), [item1, item2, item3])
+        self.assertEqual(s.waiting, {})
+
+        # Membership still works once the hash is dropped
+        s.finish()
+        self.assertTrue(s.members is None)
+        self.assertTrue(item3 in s)
+        self.assertFalse(4 in s)
+
+
+class TestMemoize(unittest.TestCase):
+    def test_memoize_sets(self):
+        parser = ExprParser()
+        parser.memoize_sets = True
+        parser.compile()
+        plain = ExprParser()
+        plain.compile()
+        tokens = scan_expression("+".join(["1*2+3"] * 20))
+        result = parser.parse_result(tokens, keep_chart=True)
+        self.assertTrue(result.stats["replayed"] > len(tokens) // 2)
+        expected = plain.parse_result(tokens, keep_chart=True)
+        self.assertEqual(result.tree, expected.tree)
+        self.assertEqual(result.chart[:2], expected.chart[:2])
+
+        # Sets are recorded the second time they come up, in the same
+        # parse or another, and replayed after that
+        parser.parse(scan_expression("4*5+6*7"))
+        parser.parse(scan_expression("5*6+7*8"))
+        tokens = scan_expression("8*9+1*2")
+        result = parser.parse_result(tokens)
+        self.assertEqual(result.stats["replayed"], len(tokens) + 1)
+        self.assertEqual(result.tree, plain.parse(tokens))
+
+        # Parsers whose reductions are checked don't replay sets
+        checked = CheckedExprParser()
+        checked.memoize_sets = True
+        self.assertEqual(checked.parse_result(tokens).stats["replayed"], 0)
+        self.assertRaises(SyntaxError, checked.parse, scan_expression("1*0+1*0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,387 @@
+import unittest
+
+from spark_parser.scanner import GenericToken
+from spark_parser.spark import GenericParser
+from test_spark import ExprParser, scan_expression
+
+
+class Ambiguous(GenericParser):
+    """An ambiguous grammar with a nullable nonterminal"""
+
+    def p_rules(self, args):
+        """
+        expr ::= expr ADD expr
+        expr ::= sign NUMBER
+        sign ::= MINUS
+        sign ::=
+        """
+        return (args[0] if len(args) == 1 else tuple(args))
+
+    def resolve(self, rule):
+        self.resolved.append(rule)
+        return rule[0]
+
+
+class Tied(GenericParser):
+    """Rules in one method, so ambiguity() can't tell them apart"""
+
+    def p_rules(self, args):
+        """
+        s ::= c NUMBER
+        s ::= NUMBER
+        c ::=
+        """
+        return tuple(args)
+
+
+class Nested(GenericParser):
+    """a ::= a a, with ties between rules in one method"""
+
+    def p_rules(self, args):
+        """
+        s ::= a END
+        a ::= NUMBER
+        a ::= a a
+        """
+        return args[0] if len(args) == 1 else tuple(args)
+
+
+class Shortcut(GenericParser):
+    """s ::= d NUMBER directly, and by way of the unit rule s ::= b"""
+
+    def p_unit(self, args):
+        """
+        s ::= b
+        b ::= d NUMBER
+        """
+        return ("unit", tuple(args))
+
+    def p_rules(self, args):
+        """
+        s ::= d NUMBER
+        d ::= NUMBER NUMBER END
+        """
+        return tuple(args)
+
+
+class Options(GenericParser):
+    """A rule with many nullable symbols"""
+
+    _MAX_NULLABLE = 4
+
+    def p_rules(self, args):
+        """
+        stmt ::= a b NAME c d e f g h
+        a ::= A?
+        b ::= B?
+        c ::= C?
+        d ::= D?
+        e ::= E?
+        f ::= F?
+        g ::= G?
+        h ::= H?
+        """
+        return [arg for arg in args if arg]
+
+
+class AllOptions(Options):
+    _MAX_NULLABLE = None
+
+
+class Overgrown(GenericParser):
+    """A grammar with rules that can't be used"""
+
+    prune_rules = True
+
+    def p_rules(self, args):
+        """
+        expr ::= expr ADD term
+        expr ::= term
+        term ::= NUMBER
+        term ::= loop NUMBER
+        loop ::= loop ADD
+        term ::= missing NUMBER
+        stmt ::= expr SEMI
+        """
+        return tuple(args)
+
+
+class Hollow(GenericParser):
+    """Only the empty rule of opt, and no rule of loop, can be used"""
+
+    prune_rules = True
+
+    def p_rules(self, args):
+        """
+        opt ::=
+        opt ::= loop NUMBER
+        loop ::= loop ADD
+        """
+        return tuple(args)
+
+    def error(self, tokens, index):
+        raise SyntaxError(index)
+
+
+class Interleaved(GenericParser):
+    """Nullable nonterminals whose rules tie within methods"""
+
+    def p_m0(self, args):
+        """
+        b ::=
+        c ::= b
+        e ::= d Z c
+        """
+        return ("m0",) + tuple(args)
+
+    def p_m1(self, args):
+        """
+        e ::= X c
+        a ::= d
+        e ::= a
+        """
+        return ("m1",) + tuple(args)
+
+    def p_m2(self, args):
+        """
+        a ::= X
+        b ::= e a Z
+        d ::= b c c
+        """
+        return ("m2",) + tuple(args)
+
+    def p_m3(self, args):
+        """
+        c ::= X
+        c ::=
+        """
+        return ("m3",) + tuple(args)
+
+
+class UnitTie(GenericParser):
+    """Y Y is A ::= S Y with S ::= A ::= Y, or A ::= B Y with B ::= Y:
+    rules of one method, which ambiguity() can't tell apart"""
+
+    def p_m1(self, args):
+        """
+        B ::= Y
+        A ::= S Y
+        S ::= X
+        A ::= B Y
+        """
+        return ("m1",) + tuple(args)
+
+    def p_m0(self, args):
+        """
+        A ::= Y
+        S ::= A
+        """
+        return ("m0",) + tuple(args)
+
+
+def p_extra(args):
+    return ("extra",) + tuple(args)
+
+
+def tokens(kinds):
+    return [GenericToken(kind, kind.lower()) for kind in kinds.split()]
+
+
+class TestTables(unittest.TestCase):
+    def test_numbering(self):
+        parser = Ambiguous("expr")
+        parser.makeTables()
+        for rule, ruleno in parser.rule2id.items():
+            self.assertEqual(parser.id2rule[ruleno], rule)
+            lhs, rhs = rule
+            self.assertEqual(parser.sym_names[parser.rule_lhs[ruleno]], lhs)
+            self.assertEqual(
+                tuple([parser.sym_names[sym] for sym in parser.rule_rhs[ruleno]]), rhs
+            )
+            self.assertTrue(parser.sym_nonterminal[parser.sym2id[lhs]])
+        self.assertTrue(parser.sym_nullable[parser.sym2id[r"\e_sign"]])
+        self.assertFalse(parser.sym_nonterminal[parser.sym2id["NUMBER"]])
+        self.assertEqual(parser.sym_names[0], None)
+
+    def test_parse(self):
+        parser = Ambiguous("expr")
+        parser.resolved = []
+        tree = parser.parse(tokens("NUMBER ADD MINUS NUMBER ADD NUMBER"))
+        self.assertTrue(len(parser.resolved) > 0)
+        self.assertEqual(len(tree), 3)
+        self.assertEqual(tree, parser.parse(tokens("NUMBER ADD MINUS NUMBER ADD NUMBER")))
+
+    def test_tie(self):
+        # Every rule is expanded before the rules that leave out
+        # nullable symbols, as one worklist over all of them would
+        parser = Tied("s")
+        parser.makeTables()
+        self.assertEqual(
+            parser.newrules["s"],
+            [("s", ("c", "NUMBER")), ("s", ("NUMBER",)), ("s", (r"\e_c", "NUMBER"))],
+        )
+        data = tokens("NUMBER")
+        self.assertEqual(parser.parse(data), ((), data[0]))
+
+        # The last of the rules wins, not the shortest
+        data = tokens("NUMBER NUMBER NUMBER END")
+        for unit_rules in (None, "chain"):
+            parser = Nested("s")
+            parser.unit_rules = unit_rules
+            self.assertEqual(
+                parser.parse(data), ((data[0], (data[1], data[2])), data[3])
+            )
+
+    def test_unit_rules(self):
+        data = tokens("NUMBER NUMBER END NUMBER")
+        parser = Shortcut("s")
+        tree = parser.parse(data)
+        self.assertEqual(tree[0], "unit")
+        # A copy of b ::= d NUMBER for s would be the same rule as
+        # s ::= d NUMBER, so the unit rule is kept
+        chained = Shortcut("s")
+        chained.unit_rules = "chain"
+        self.assertEqual(chained.parse(data), tree)
+        self.assertTrue(("s", ("b",)) in chained.newrules["s"])
+
+    def test_unit_chains(self):
+        tokens = scan_expression("1+2*3")
+        parser = ExprParser()
+        chained = ExprParser()
+        chained.unit_rules = "chain"
+        collapsed = ExprParser()
+        collapsed.unit_rules = "collapse"
+        result = parser.parse_result(tokens)
+        chained_result = chained.parse_result(tokens)
+        tree = result.tree
+        self.assertEqual(tree, chained_result.tree)
+        # Fewer items: expr ::= term and term ::= factor are gone
+        self.assertTrue(chained_result.stats["links"] < result.stats["links"])
+        chained.compile()
+        self.assertEqual(tree, chained.parse(tokens))
+
+        # Without the chain, expr ::= term ::= factor is just the factor
+        tree = collapsed.parse(scan_expression("1"))
+        self.assertEqual(tree, parser.parse(scan_expression("1"))[0][0])
+
+        # Only where rules of one method tie can the tree differ: here,
+        # for input that starts with Y Y
+        parser = UnitTie("S")
+        chained = UnitTie("S")
+        chained.unit_rules = "chain"
+        for data in ("X", "Y", "X Y", "X Y Y", "X Y Y Y"):
+            tokens = [GenericToken(kind, kind.lower()) for kind in data.split()]
+            self.assertEqual(parser.parse(tokens), chained.parse(tokens))
+        tokens = [GenericToken("Y", "y")] * 2
+        y = tokens[0]
+        self.assertEqual(parser.parse(tokens), ("m0", ("m1", ("m0", ("m0", y)), y)))
+        self.assertEqual(chained.parse(tokens), ("m0", ("m1", ("m1", y), y)))
+        tokens.append(y)
+        self.assertEqual(
+            parser.parse(tokens),
+            ("m0", ("m1", ("m0", ("m1", ("m0", ("m0", y)), y)), y)),
+        )
+        self.assertEqual(
+            chained.parse(tokens), ("m0", ("m1", ("m0", ("m1", ("m1", y), y)), y))
+        )
+
+    def test_update(self):
+        parser = Ambiguous("expr")
+        parser.resolved = []
+        parser.makeTables()
+        data = tokens("NUMBER ADD MINUS NUMBER")
+        tree = parser.parse(data)
+        nstates = len(parser.states)
+        for edit in (
+            # a new nonterminal
+            lambda p: p.addRule("expr ::= LPAREN expr RPAREN", p.p_rules),
+            # sign is no longer nullable, then is again
+            lambda p: p.remove_rules("sign ::="),
+            lambda p: p.addRule("plus ::= PLUS\nplus ::=", p.p_rules),
+            lambda p: p.addRule("sign ::= plus", p.p_rules),
+        ):
+            edit(parser)
+            self.assertTrue(parser.updateTables())
+            fresh = Ambiguous("expr")
+            fresh.rules, fresh.rule2func = parser.rules, parser.rule2func
+            fresh.makeTables()
+            self.assertEqual(parser.nullable, fresh.nullable)
+            self.assertEqual(parser.new2old, fresh.new2old)
+            # Rules come in the same order, which ties in ambiguity() go by
+            for lhs, rulelist in fresh.newrules.items():
+                self.assertEqual(parser.newrules[lhs], rulelist)
+            self.assertEqual(sorted(parser.newrules), sorted(fresh.newrules))
+        # States not affected by the changes were kept
+        self.assertTrue(len(parser.states) >= nstates)
+
+        self.assertEqual(tree, parser.parse(data))
+        self.assertEqual(
+            len(parser.parse(tokens("LPAREN PLUS NUMBER RPAREN ADD NUMBER"))), 3
+        )
+
+    def test_update_order(self):
+        parser = Interleaved("a")
+        parser.parse(tokens("X"))
+        fresh = Interleaved("a")
+        for p in (parser, fresh):
+            p.addRule("b ::= a X a ::= b a ::= ", p_extra)
+        self.assertEqual(parser.parse([]), ("extra", ("m0",)))
+        self.assertEqual(fresh.parse([]), ("extra", ("m0",)))
+        for data in ("X", "X X", "X Z X", "X X Z X"):
+            self.assertEqual(parser.parse(tokens(data)), fresh.parse(tokens(data)))
+
+    def test_split(self):
+        parser = Options("stmt")
+        parser.makeTables()
+        self.assertEqual(len(parser.rules["stmt"]), 1)
+        nrules = len(parser.id2rule)
+        full = AllOptions("stmt")
+        full.makeTables()
+        self.assertTrue(nrules * 4 < len(full.id2rule))
+        for data in ("NAME", "A NAME", "NAME H", "B NAME C E G", "A B NAME C D E F G H"):
+            self.assertEqual(parser.parse(tokens(data)), full.parse(tokens(data)))
+
+        # Every cut has to leave fewer nullable symbols to split
+        parser = Options("stmt")
+        parser._MAX_NULLABLE = 1
+        self.assertRaises(ValueError, parser.makeTables)
+
+    def test_prune(self):
+        parser = Overgrown("expr")
+        parser.makeTables()
+        self.assertEqual(
+            parser.pruned_rules,
+            [
+                ("term", ("loop", "NUMBER")),
+                ("term", ("missing", "NUMBER")),
+                ("loop", ("loop", "ADD")),
+                ("stmt", ("expr", "SEMI")),
+            ],
+        )
+        for sym in ("loop", "missing", "stmt", "SEMI"):
+            self.assertFalse(sym in parser.sym2id)
+        full = Overgrown("expr")
+        full.prune_rules = False
+        data = tokens("NUMBER ADD NUMBER ADD NUMBER")
+        self.assertEqual(parser.parse(data), full.parse(data))
+        self.assertTrue(len(parser.id2rule) < len(full.id2rule))
+
+        # The start symbol stays a nonterminal when its rules are gone
+        def parse(parser, data):
+            try:
+                return parser.parse(tokens(data))
+            except SyntaxError:
+                return SyntaxError
+
+        for start in ("opt", "loop"):
+            parser = Hollow(start)
+            full = Hollow(start)
+            full.prune_rules = False
+            for data in ("", "NUMBER", "loop", "opt"):
+                self.assertEqual(parse(parser, data), parse(full, data))
+        self.assertEqual(parse(Hollow("opt"), ""), ())
+        self.assertEqual(parse(Hollow("loop"), "loop"), SyntaxError)
+
+
+if __name__ == "__main__":
+    unittest.main()